@@ -2,12 +2,21 @@
 import os
 import sys
 import pygame
+import numpy
 import euclid
-import pytmx
 import copy
+import math
 import random
-import pytmx.util_pygame
-import datetime
+import collections
+import argparse
+import time
+import struct
+import json
+import glob
+import threading
+import multiprocessing
+import itertools
+import socket
 
 TITLE = 'GBOY'
 COLORS = [
@@ -20,21 +29,77 @@ SCALE = 6
 SCREEN_W = 160
 SCREEN_H = 140
 SCREEN_SZ = (SCREEN_W, SCREEN_H)
-SCALED_SZ = (SCALE * SCREEN_W, SCALE * SCREEN_H)
 FONT = './data/fonts/Early GameBoy.ttf'
 TRANS = (255,0,255)
+PALETTE = None # surface holding the palette every other one is made on
 JOY_AXIS = 0
+TICK_RATE = 60 # simulation steps per second
+MAX_STEPS = 5 # most steps run to catch up before a frame is drawn
+CHUNK = 16 # tiles per side of a pre-rendered map chunk
+CHUNK_BUDGET = 4 << 20 # bytes of pre-rendered chunks each level keeps
+
+# tile flags
+SOLID = 1
+LADDER = 2
+KILL = 4
+KEY = 8
+EXIT = 16
 
 def sgn(a):
     return (a > 0) - (a < 0)
 
+def palette():
+    # every surface is 8 bit on one palette, so blits only copy indices: the
+    # four shades, TRANS, then any other colour the sprites use. surfaces
+    # are converted to this one's format (see blank) since set_palette never
+    # gives byte identical palettes, and SDL only copies (and RLE encodes)
+    # on an exact match
+    global PALETTE
+    if not PALETTE:
+        colors = COLORS + [TRANS]
+        for fn in sorted(glob.glob('./data/gfx/*.png')):
+            img = pygame.image.load(fn)
+            for p in numpy.unique(pygame.surfarray.array2d(img)):
+                c = tuple(img.unmap_rgb(int(p)))[:3]
+                if c not in colors:
+                    colors += [c]
+        PALETTE = pygame.Surface((1, 1), 0, 8)
+        PALETTE.set_palette(colors[:256])
+    return PALETTE
+
+def blank(size):
+    return pygame.Surface(size, 0, 8).convert(palette())
+
+def indexed(img):
+    # 8 bit copy of img, its colorkey becomes TRANS and any colour not on
+    # the palette the nearest one that is
+    out = blank(img.get_size())
+    out.fill(TRANS)
+    if img.get_bitsize() == 8:
+        out.blit(img, (0, 0))
+    else:
+        # SDL rounds deeper colours to 3-3-2 bits before looking them up,
+        # which runs the two light shades together, so look them up here
+        rgb = pygame.surfarray.array3d(img).astype(numpy.int32)
+        packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        colors, inv = numpy.unique(packed, return_inverse=True)
+        colors = numpy.column_stack((colors >> 16, (colors >> 8) & 255, colors & 255))
+        pal = numpy.array([tuple(c)[:3] for c in palette().get_palette()], numpy.int32)
+        near = ((colors[:, None] - pal[None]) ** 2).sum(axis=2).argmin(axis=1)
+        index = near.astype(numpy.uint8)[inv].reshape(packed.shape)
+        key = img.get_colorkey()
+        if key:
+            index[packed == (key[0] << 16 | key[1] << 8 | key[2])] = out.map_rgb(TRANS)
+        if img.get_flags() & pygame.SRCALPHA:
+            index[pygame.surfarray.array_alpha(img) < 128] = out.map_rgb(TRANS)
+        pygame.surfarray.blit_array(out, index)
+    out.set_colorkey(TRANS, pygame.RLEACCEL)
+    return out
+
 def load_image(fn):
-    img = pygame.image.load(fn)
-    img.set_colorkey(TRANS)
-    return img
+    return indexed(pygame.image.load(fn))
 
-def tileset(fn, **kwargs):
-    img = load_image(fn)
+def tileset(img, **kwargs):
     w, h = img.get_size()
     tiles = []
     hflip = kwargs.get('hflip', False)
@@ -42,26 +107,322 @@ def tileset(fn, **kwargs):
     for i in xrange(0, w, h):
         tiles += [img.subsurface((i,0,h,h))]
         tiles[-1] = pygame.transform.flip(tiles[-1], hflip, vflip)
+        tiles[-1].set_colorkey(TRANS, pygame.RLEACCEL)
     return tiles
 
+class Assets:
+    # loads each image, sprite strip and sound once and hands out shared refs
+    def __init__(self):
+        self.images = {}
+        self.strips = {}
+        self.sounds = {}
+    
+    def image(self, fn):
+        fn = os.path.normpath(fn)
+        img = self.images.get(fn)
+        if not img:
+            img = self.images[fn] = load_image(fn)
+        return img
+    
+    def strip(self, fn, hflip=False, vflip=False):
+        key = (os.path.normpath(fn), hflip, vflip)
+        tiles = self.strips.get(key)
+        if not tiles:
+            tiles = self.strips[key] = tileset(self.image(fn), hflip=hflip, vflip=vflip)
+        return tiles
+    
+    def refresh(self, fn):
+        # an image changed on disk: redrawn into the surfaces already handed
+        # out if it's the same size, else only what loads it next sees it
+        fn = os.path.normpath(fn)
+        img = self.images.get(fn)
+        if not img:
+            return
+        new = load_image(fn)
+        strips = [k for k in self.strips if k[0] == fn]
+        if new.get_size() != img.get_size():
+            self.images[fn] = new
+            for k in strips:
+                del self.strips[k]
+            return
+        img.fill(TRANS)
+        img.blit(new, (0, 0))
+        for k in strips:
+            for old, tile in zip(self.strips[k], tileset(img, hflip=k[1], vflip=k[2])):
+                old.fill(TRANS)
+                old.blit(tile, (0, 0))
+    
+    def sound(self, fn):
+        fn = os.path.normpath(fn)
+        snd = self.sounds.get(fn)
+        if not snd:
+            snd = self.sounds[fn] = pygame.mixer.Sound(fn)
+        return snd
+    
+    def preload(self, path='./data'):
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                ext = os.path.splitext(f)[1].lower()
+                if ext == '.png':
+                    self.image(os.path.join(root, f))
+                elif ext == '.wav':
+                    self.sound(os.path.join(root, f))
+
+class Scope(object):
+    __slots__ = ('prof', 'name', 't')
+    
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+    
+    def __enter__(self):
+        self.t = time.time()
+    
+    def __exit__(self, *exc):
+        self.prof.add(self.name, self.t, time.time())
+
+class NullScope(object):
+    __slots__ = ()
+    
+    def __enter__(self):
+        pass
+    
+    def __exit__(self, *exc):
+        pass
+
+NULL_SCOPE = NullScope()
+
+class NullProfiler(object):
+    # what Game.prof is when profiling is off, every call does nothing
+    __slots__ = ()
+    enabled = False
+    
+    def __call__(self, name):
+        return NULL_SCOPE
+    
+    def count(self, name, n=1):
+        pass
+    
+    def frame(self):
+        pass
+
+class Profiler(object):
+    # named scopes and counters, totalled per frame for the overlay and
+    # kept as trace events for chrome://tracing, the last history of them
+    enabled = True
+    
+    def __init__(self, trace=True, history=1 << 18):
+        self.start = time.time()
+        self.trace = collections.deque(maxlen=history) if trace else None
+        self.times = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.last_times = {}
+        self.last_counts = {}
+        self.frames = 0
+    
+    def __call__(self, name):
+        return Scope(self, name)
+    
+    def add(self, name, t0, t1):
+        self.times[name] += t1 - t0
+        if self.trace is not None:
+            self.trace.append((name, t0, t1))
+    
+    def count(self, name, n=1):
+        self.counts[name] += n
+    
+    def frame(self):
+        self.last_times = self.times
+        self.last_counts = self.counts
+        if self.trace is not None:
+            self.trace.append((None, time.time(), self.counts))
+        self.times = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.frames += 1
+    
+    def save(self, fn):
+        events = []
+        for name, t0, t1 in self.trace:
+            ts = (t0 - self.start) * 1000000
+            if name is None:
+                events.append({'name': 'counters', 'ph': 'C', 'ts': ts,
+                    'pid': 0, 'tid': 0, 'args': dict(t1)})
+            else:
+                events.append({'name': name, 'ph': 'X', 'ts': ts,
+                    'dur': (t1 - t0) * 1000000, 'pid': 0, 'tid': 0})
+        with open(fn, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def timer(t):
+    # h:mm:ss.cc, what str(timedelta) gives cut to hundredths
+    cs = int(round(t * 1000000)) / 10000
+    s, cs = divmod(cs, 100)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return '%d:%02d:%02d.%02d' % (h, m, s, cs)
+
+class Pacer(object):
+    # paces frames to the display and picks which ones get drawn: logic
+    # steps at its own rate whatever drawing costs, drawing is decimated to
+    # what's left of each frame, skipped when the steps ran late, and never
+    # skipped more than max_skip frames in a row so the picture can't lag
+    # input by more than that
+    MODES = ('steady', 'vsync', 'low-latency')
+    SLACK = 0.002 # margin for sleep's granularity when starting late
+
+    def __init__(self, dt, mode='steady', hz=60, max_skip=3, history=600):
+        self.dt = dt
+        self.mode = mode
+        self.period = 1.0 / hz
+        self.max_skip = max_skip
+        self.vsync = False # whether the window actually waits for vblank
+        self.logic_cost = 0.0 # moving averages of a step and of a frame drawn
+        self.draw_cost = 0.0
+        self.times = collections.deque(maxlen=history) # between presents
+        self.due = None # when the frame being run should be on screen
+        self.woke = None
+        self.shown = None
+        self.flipped = False
+        self.skipped = 0 # in a row
+        self.drawn = 0
+        self.skips = 0
+
+    def lead(self):
+        # how long before its deadline a frame has to start to make it
+        steps = self.period / self.dt
+        return min(self.period,
+            self.logic_cost * steps + self.draw_cost + self.SLACK)
+
+    def wait(self):
+        # sleep until the next frame should start, returns the time since
+        # the last one started for the logic to catch up on
+        now = time.time()
+        if self.due is None:
+            self.due = now + self.period
+        elif self.flipped and self.vsync:
+            # the flip returned on a vblank, the next is a period on
+            self.due = now + self.period
+        else:
+            self.due += self.period
+            if self.due < now:
+                # overran, start over from here rather than rush to catch up
+                self.due = now + self.period
+        self.flipped = False
+        # low latency starts just in time, so input is read as late as it
+        # can be; otherwise a frame starts as soon as its period does
+        lead = self.lead() if self.mode == 'low-latency' else self.period
+        if self.due - lead > now:
+            time.sleep(self.due - lead - now)
+            now = time.time()
+        elapsed = now - self.woke if self.woke else 0.0
+        self.woke = now
+        return elapsed
+
+    def stepped(self, t):
+        self.logic_cost += (t - self.logic_cost) * 0.1
+
+    def drawing(self):
+        # draw every nth frame, n being how many frames' spare time it takes
+        spare = self.period - self.logic_cost * self.period / self.dt
+        n = self.draw_cost / spare if spare > 0 else self.max_skip + 1
+        if self.skipped >= self.max_skip or (
+                self.skipped + 1 >= n and time.time() < self.due):
+            self.skipped = 0
+            return True
+        self.skipped += 1
+        self.skips += 1
+        return False
+
+    def drew(self, t0, flipped):
+        now = time.time()
+        self.draw_cost += (now - t0 - self.draw_cost) * 0.1
+        if self.shown is not None:
+            self.times.append(now - self.shown)
+        self.shown = now
+        self.flipped = flipped
+        self.drawn += 1
+
+    def percentiles(self, qs=(50, 95, 99)):
+        # of the time between frames shown, in seconds
+        if not self.times:
+            return [0.0] * len(qs)
+        return [float(p) for p in numpy.percentile(list(self.times), qs)]
+
+    def report(self):
+        print 'frames: %d drawn, %d skipped, %s ms p50/p95/p99' % (
+            self.drawn, self.skips,
+            '/'.join('%.1f' % (t * 1000.0) for t in self.percentiles()))
+
+class Text:
+    # rendered strings keyed by text and color, least recently used
+    # dropped first, and single glyphs to compose text that keeps changing
+    def __init__(self, font, size=64):
+        self.font = font
+        self.size = size
+        self.cache = collections.OrderedDict()
+        self.glyphs = {}
+    
+    def render(self, s, color):
+        key = (s, color)
+        surface = self.cache.pop(key, None)
+        if not surface:
+            surface = indexed(self.font.render(s, 0, color))
+            if len(self.cache) >= self.size:
+                self.cache.popitem(last=False)
+        self.cache[key] = surface
+        return surface
+    
+    def glyph(self, c, color):
+        key = (c, color)
+        surface = self.glyphs.get(key)
+        if not surface:
+            surface = self.glyphs[key] = indexed(self.font.render(c, 0, color))
+        return surface
+    
+    def draw(self, buf, s, color, pos):
+        x, y = pos
+        for c in s:
+            g = self.glyph(c, color)
+            buf.blit(g, (x, y))
+            x += g.get_width()
+
 class Object(object):
+    __slots__ = (
+        'game', 'attached', 'slot', 'gen', 'span',
+        'pos', 'prev', 'vel', 'sz', 'surface', 'by_ladder'
+    )
+    box = None # size of the box tiles are collided with, sz if None
+    
     def __init__(self, **kwargs):
         self.game = kwargs.get('game', None)
         self.attached = False
-        if self.game:
-            self.game.world.attach(self)
+        self.slot = -1
+        self.gen = 0
+        self.span = None
         
         self.pos = euclid.Vector2(*kwargs.get('pos', (0.0, 0.0)))
+        self.prev = copy.copy(self.pos) # position at the start of the step
         self.vel = euclid.Vector2(*kwargs.get('vel', (0.0, 0.0)))
         self.sz = euclid.Vector2(*kwargs.get('sz', (0.0, 0.0)))
         self.surface = kwargs.get('surface', None)
+        self.by_ladder = False # set by World.collision and World.touch
+        if self.game:
+            self.game.world.attach(self)
     
-    def give(item):
+    def give(self, item):
+        return False
+    
+    def hit(self, owner):
+        # struck by a bullet fired by owner, True if it stops the bullet
         return False
     
     def rect(self):
         return pygame.Rect(self.pos.x, self.pos.y, self.sz.x, self.sz.y)
     
+    def lerp(self, a):
+        # position a fraction of the way through the current step
+        return self.prev + (self.pos - self.prev) * a
+    
     def logic(self, t):
         self.pos += self.vel * t
         
@@ -72,66 +433,169 @@ class Object(object):
     
     def render(self, view):
         if self.attached and self.surface:
-            self.game.screen.buf.blit(self.surface, self.pos - view)
+            self.game.screen.buf.blit(self.surface, self.lerp(self.game.alpha) - view)
 
 class Screen(Object):
-    def __init__(self,screen):
+    # the low-res buffer everything draws into, and how it gets upscaled
+    # into the window
+    def __init__(self, screen, scale=SCALE, filter='nearest'):
         self.pos = euclid.Vector2(0.0, 0.0)
         self.sz = euclid.Vector2(SCREEN_W, SCREEN_H)
-        self.buf = pygame.Surface(SCREEN_SZ).convert()
-        self.surface = pygame.Surface(SCALED_SZ).convert()
+        self.buf = blank(SCREEN_SZ)
+        self.palette = [tuple(c)[:3] for c in self.buf.get_palette()]
+        # buf converted to the window's format, what gets scaled
+        self.out = pygame.Surface(SCREEN_SZ).convert()
         self.screen = screen
+        self.scale = scale
+        self.filter = filter
+        self.last = None # buf as last presented
+        self.shown = None # palette buf was last presented with
+        # buf's indices under an effect's palette; buf itself keeps the one
+        # it was made with, or every blit into it stops being a plain copy
+        self.fx = blank(SCREEN_SZ)
+        self.effects = [] # palettes to present the next frames with
+        
+        # scale2x as many times as the scale allows, nearest for the rest
+        self.chain = []
+        if filter == 'scale2x':
+            n = 1
+            while scale % (n * 2) == 0:
+                n *= 2
+                self.chain += [pygame.Surface((SCREEN_W * n, SCREEN_H * n)).convert()]
+        if self.chain and self.chain[-1].get_size() == screen.get_size():
+            self.chain[-1] = screen
+    
+    def shades(self, order):
+        # the palette with the four shades swapped around
+        return [COLORS[i] for i in order] + self.palette[len(COLORS):]
+    
+    def flash(self, frames=6):
+        self.effects = [self.shades((3, 2, 1, 0))] * frames
+    
+    def fade(self, frames=12):
+        # in from the lightest shade, one shade at a time
+        self.effects = []
+        for k in (3, 2, 1):
+            pal = self.shades([max(0, i - k) for i in xrange(len(COLORS))])
+            self.effects += [pal] * (frames / 3)
+    
+    def expose(self):
+        # the window may have lost what was presented, give it all of buf
+        self.last = None
+    
+    def dirty(self):
+        # bounding rect of what changed in buf since it was last presented
+        px = pygame.surfarray.pixels2d(self.buf)
+        if self.last is None:
+            self.last = px.copy()
+            return self.buf.get_rect()
+        diff = px != self.last
+        cols = numpy.flatnonzero(diff.any(axis=1))
+        if not cols.size:
+            return None
+        rows = numpy.flatnonzero(diff.any(axis=0))
+        self.last[...] = px
+        del px
+        return pygame.Rect(
+            int(cols[0]), int(rows[0]),
+            int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1
+        )
     
     def render(self):
-        pygame.transform.scale(self.buf, SCALED_SZ, self.surface)
-        self.screen.blit(self.surface, (0,0))
+        # scale straight into the window, returns the window rects updated
+        pal = self.effects.pop(0) if self.effects else self.palette
+        r = self.dirty()
+        if pal is not self.shown:
+            # same indices, different colours
+            self.shown = pal
+            r = self.buf.get_rect()
+        if not r:
+            return []
+        
+        # the only conversion out of 8 bit, at the small size; effects are
+        # buf's indices read through another palette for the blit
+        src = self.buf
+        if pal is not self.palette:
+            src = self.fx
+            src.set_palette(pal)
+            pygame.surfarray.pixels2d(src)[...] = pygame.surfarray.pixels2d(self.buf)
+        self.out.blit(src, r, r)
+        
+        if self.chain:
+            # scale2x reads neighbours, so redo the whole frame
+            src = self.out
+            for dst in self.chain:
+                pygame.transform.scale2x(src, dst)
+                src = dst
+            if src is not self.screen:
+                pygame.transform.scale(src, self.screen.get_size(), self.screen)
+            return [self.screen.get_rect()]
+        s = self.scale
+        dst = pygame.Rect(r.x * s, r.y * s, r.w * s, r.h * s)
+        if r.size == SCREEN_SZ:
+            pygame.transform.scale(self.out, dst.size, self.screen)
+        else:
+            pygame.transform.scale(self.out.subsurface(r), dst.size, self.screen.subsurface(dst))
+        return [dst]
         
-class Bullet(Object):
-    def __init__(self, **kwargs):
-        super(self.__class__, self).__init__(**kwargs)
-        self.surface = load_image('./data/gfx/bullet.png')
-        w,h = self.surface.get_size()
-        self.sz = euclid.Vector2(w*1.0, h*1.0)
-
 class Guy(Object):
+    __slots__ = (
+        'move', 'surfaces', 'keys', 'anim_point', 'direction', 'chan',
+        'jump_snd', 'shoot_snd', 'item_snd', 'jump_time', 'shoot_time',
+        'strafe', 'jumping', 'on_ladder', 'on_ground',
+        'on_ceiling', 'items', 'ctrl'
+    )
+    
+    speed = 100.0
+    run_mult = 1.5
+    anim_speed = 8.0
+    #jump_accel = 3000.0
+    jump_vel = 220.0
+    fall_accel = 1500.0
+    fall_vel = 300.0
+    max_jump_time = 0.2
+    shoot_delay = 0.25
+    size = (10.0, 10.0)
+    # tiles only ever saw pixels int(pos) to int(pos) + 8 of the sprite, so
+    # pos + 8 itself: 8px with the far edges closed, which the maps were
+    # built around. a hair over 8 keeps him off exact tile alignment, where
+    # 8 would fit him down 1 tile gaps the pixels never let him through
+    box = euclid.Vector2(8.0 + 1.0 / 64, 8.0 + 1.0 / 64)
+    frames = {
+        "right": [0,1,0,2],
+        "left": [3,4,3,5],
+        "climb": [6,7]
+    }
+    
     def __init__(self, **kwargs):
+        kwargs['sz'] = self.size
         super(self.__class__, self).__init__(**kwargs)
         
-        self.speed = 100.0
-        self.run_mult = 1.5
-        self.sz = euclid.Vector2(10.0, 10.0)
-        self.anim_speed = 8.0
-        #self.jump_accel = 3000.0
-        self.jump_vel = 220.0
-        self.fall_accel = 1500.0
-        self.fall_vel = 300.0
         self.move = euclid.Vector2(0.0, 0.0)
-        self.surfaces = tileset('./data/gfx/guy2.png')
-        self.surfaces += tileset('./data/gfx/guy2.png', hflip=True)
-        self.frames = {
-            "right": [0,1,0,2],
-            "left": [3,4,3,5],
-            "climb": [6,7]
-        }
+        assets = self.game.assets
+        self.surfaces = (
+            assets.strip('./data/gfx/guy2.png') +
+            assets.strip('./data/gfx/guy2.png', hflip=True)
+        )
         self.keys = 0
         self.anim_point = 0.0
         self.direction = "right"
         self.surface = self.surfaces[self.frames[self.direction][0]]
         self.chan = pygame.mixer.Channel(0)
-        self.jump_snd = pygame.mixer.Sound('./data/sfx/jump.wav')
-        self.shoot_snd = pygame.mixer.Sound('./data/sfx/shoot.wav')
-        self.item_snd = pygame.mixer.Sound('./data/sfx/key.wav')
+        self.jump_snd = assets.sound('./data/sfx/jump.wav')
+        self.shoot_snd = assets.sound('./data/sfx/shoot.wav')
+        self.item_snd = assets.sound('./data/sfx/key.wav')
         self.jump_time = 0.0
-        self.max_jump_time = 0.2
         self.shoot_time = 0
-        self.shoot_delay = 0.25
         
         self.strafe = False
         #self.running = False
         self.jumping = False
-        self.by_ladder = False
         self.on_ladder = False
+        self.on_ground = False
+        self.on_ceiling = False
         self.items = []
+        self.ctrl = None # keys held by whoever steers it, if not the local player
         
     def give(self, item):
         if item == 'key':
@@ -139,9 +603,17 @@ class Guy(Object):
         self.chan.play(self.item_snd)
         return True
     
+    def hit(self, owner):
+        if owner is self:
+            return False
+        self.attached = False
+        return True
+    
     def interface(self):
+        keys = self.game.keys if self.ctrl is None else self.ctrl
+        joys = self.game.joys if self.ctrl is None else ()
         self.move = euclid.Vector2(0.0, 0.0)
-        for k in self.game.keys:
+        for k in keys:
             if k == pygame.K_LEFT or k == pygame.K_j:
                 self.move += euclid.Vector2(-1.0, 0.0)
             if k == pygame.K_RIGHT or k == pygame.K_l:
@@ -155,7 +627,7 @@ class Guy(Object):
             if k == pygame.K_SPACE:
                 self.shoot()
 
-        for joy in self.game.joys:
+        for joy in joys:
             ax = JOY_AXIS
             if abs(joy.get_axis(ax)) > 0.2:
                 if self.on_ladder:
@@ -180,9 +652,9 @@ class Guy(Object):
         self.move.y = max(-1.0, min(1.0, self.move.y))
         
         joy_jump = False
-        if len(self.game.joys) >= 1:
-            joy_jump = self.game.joys[0].get_button(0)
-        self.jump(pygame.K_i in self.game.keys or pygame.K_UP in self.game.keys or joy_jump)
+        if len(joys) >= 1:
+            joy_jump = joys[0].get_button(0)
+        self.jump(pygame.K_i in keys or pygame.K_UP in keys or joy_jump)
         
     def logic(self, t):
         
@@ -222,24 +694,17 @@ class Guy(Object):
             if self.vel.x > 0:
                 self.direction = "right"
         
-        old_pos = copy.copy(self.pos)
-        
-        if self.vel.x != 0.0:
-            self.pos.x += self.vel.x * t
-            if self.game.world.collision(self):
-                self.pos.x -= t*sgn(self.vel.x)
-                while self.game.world.collision(self):
-                    self.pos.x -= t*sgn(self.vel.x)
+        # resolve each axis in one swept query against the tile grid
+        self.by_ladder = False
+        with self.game.prof('collision'):
+            if self.game.world.sweep(self, self.vel.x * t, 0.0):
                 self.vel.x = 0.0
-
-        if self.vel.y != 0.0:
-            self.pos.y += self.vel.y * t
-            if self.game.world.collision(self):
-                self.pos.y -= t*sgn(self.vel.y)
-                while self.game.world.collision(self):
-                    self.pos.y -= t*sgn(self.vel.y)
-                self.vel.y = 0.0
-                new_vel.y = 0.0
+            normal = self.game.world.sweep(self, 0.0, self.vel.y * t)
+        self.on_ground = normal < 0
+        self.on_ceiling = normal > 0
+        if normal:
+            self.vel.y = 0.0
+            new_vel.y = 0.0
         
         if self.vel.y < 0.0:
             # moving up
@@ -267,15 +732,14 @@ class Guy(Object):
             bullet_dir = -1.0 if self.direction=='left' else 1.0
             bullet_speed = 200.0
             self.shoot_time = self.shoot_delay
-            b = Bullet(
-                game=self.game,
-                pos=(self.pos.x + self.sz.x/2.0, self.pos.y + self.sz.y/2.0),
-                vel=(bullet_dir * bullet_speed, 0.0)
+            self.game.world.bullets.spawn(
+                self.pos.x + self.sz.x/2.0, self.pos.y + self.sz.y/2.0,
+                bullet_dir * bullet_speed, 0.0, self
             )
             self.chan.play(self.shoot_snd)
 
     def render(self, view):
-        self.game.screen.buf.blit(self.surface, self.pos - view)
+        self.game.screen.buf.blit(self.surface, self.lerp(self.game.alpha) - view)
 
     def jump(self, j=True):
         if self.jumping != j:
@@ -290,19 +754,7 @@ class Guy(Object):
                 self.jumping = False
     
     def can_jump(self):
-        return self.vel.y == 0.0
-        #feet = Object(
-        #    pos=(self.pos.x + 2.0, self.pos.y + self.sz.y / 2.0),
-        #    sz=(self.sz.x-4.0, self.sz.y/2.0 + 1.0)
-        #)
-        #c = self.game.world.collision(feet)
-        #return c
-        #tb = self.game.world.tile_below(self)
-        #r = copy.copy(self.rect())
-        #r.centery -= 1.0
-        #if tb:
-        #    return r.colliderect(tb.rect())
-        #return True
+        return self.on_ground
 
 class Tile:
     def __init__(self, surface):
@@ -311,121 +763,956 @@ class Tile:
 class NoSuchLevel(Exception):
     pass
 
-class World:
-    def __init__(self, fn, game):
+# compiled levels: a fixed header, then 8-byte aligned sections that map
+# straight into numpy arrays (tilesets, gid table, spawns, tile layers,
+# flags), so only the pages of a map that get used are ever read
+LEVEL_MAGIC = 'GBLV'
+LEVEL_VERSION = 2
+# magic, version, tilesets, w, h, tw, th, layers, spawns, gids, keys,
+# and the mtime and size of the tmx it was built from
+LEVEL_HEADER = struct.Struct('<4sHHIIHHHHIIdQ')
+# firstgid, tile w/h, margin, spacing, columns, length of the image path
+LEVEL_TILESET = struct.Struct('<IHHHHHH')
+FLIP_H, FLIP_V, FLIP_D = 1, 2, 4
+
+def align(n):
+    return (n + 7) & ~7
+
+def compiled(fn):
+    return os.path.splitext(fn)[0] + '.gbl'
+
+def fresh(out, fn):
+    # a compiled level is used unless the tmx next to it has changed
+    try:
+        with open(out, 'rb') as f:
+            head = LEVEL_HEADER.unpack(f.read(LEVEL_HEADER.size))
+    except (IOError, struct.error):
+        return False
+    if head[:2] != (LEVEL_MAGIC, LEVEL_VERSION):
+        return False
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return True
+    return head[11:] == (st.st_mtime, st.st_size)
+
+def tile_flags(props):
+    # a tile's flags from the names of its properties
+    f = LADDER if 'ladder' in props else SOLID
+    if 'kill' in props:
+        f |= KILL
+    if 'key' in props:
+        f |= KEY
+    if 'exit' in props:
+        f |= EXIT
+    return f
+
+class Level:
+    # a parsed map; never modified, shared by every World made from it
+    def __init__(self, fn, images=True, binary=True):
+        self.fn = fn
+        if binary and fresh(compiled(fn), fn):
+            self.read(compiled(fn), images)
+        else:
+            self.parse(fn, images)
+        self.sz = euclid.Vector2(self.w * self.tw, self.h * self.th)
+        
+        # tile layers are pre-rendered a chunk at a time as they come into
+        # view, dropping the least recently drawn past CHUNK_BUDGET
+        self.chunks = collections.OrderedDict()
+        self.cached = 0
+    
+    def parse(self, fn, images=True):
+        # pytmx is only needed for maps that aren't compiled
+        import pytmx
         try:
-            self.tmx = pytmx.util_pygame.load_pygame(fn)
-        except IOError:
+            tmx = pytmx.TiledMap(fn)
+            st = os.stat(fn)
+        except (IOError, OSError):
             raise NoSuchLevel
-            
-        for img in self.tmx.images:
-            if img:
-                img.set_colorkey(TRANS)
-        self.sz = euclid.Vector2(
-            self.tmx.width * self.tmx.tilewidth,
-            self.tmx.height * self.tmx.tileheight
-        )
         
-        line = []
-        self.game = game
-        self.objects = []
+        self.w = tmx.width
+        self.h = tmx.height
+        self.tw = tmx.tilewidth
+        self.th = tmx.tileheight
+        self.source = (st.st_mtime, st.st_size)
         
         self.spawns = []
-        for layer in self.tmx.visible_layers:
+        for layer in tmx.visible_layers:
             if isinstance(layer, pytmx.TiledObjectGroup):
                 for obj in layer:
                     if obj.name == 'S':
-                        self.spawns += [obj]
+                        self.spawns += [(obj.x, obj.y)]
         
-        self.keys = 0
+        # visible tile layers as gid grids, keys live on the first one
+        self.layers = [
+            numpy.array(tmx.layers[i].data, numpy.uint16)
+            for i in tmx.visible_tile_layers
+        ]
+        
+        # where each gid's image comes from: pytmx renumbers gids, so keep
+        # the tiled gid and flips to rebuild the image from the tileset
+        self.tilesets = []
+        for ts in tmx.tilesets:
+            cols = (ts.width - 2*ts.margin + ts.spacing) / (ts.tilewidth + ts.spacing)
+            self.tilesets += [(ts.firstgid, ts.tilewidth, ts.tileheight,
+                ts.margin, ts.spacing, cols, ts.source)]
+        self.tiled = numpy.zeros(tmx.maxgid, numpy.uint32)
+        self.xform = numpy.zeros(tmx.maxgid, numpy.uint8)
+        for tiled, gids in tmx.gidmap.items():
+            for gid, fl in gids:
+                self.tiled[gid] = tiled
+                self.xform[gid] = ((fl.flipped_horizontally and FLIP_H) |
+                    (fl.flipped_vertically and FLIP_V) |
+                    (fl.flipped_diagonally and FLIP_D))
+        
+        # flags for each gid
+        self.table = numpy.zeros(tmx.maxgid, numpy.uint8)
+        for gid in xrange(tmx.maxgid):
+            if self.tiled[gid]:
+                self.table[gid] = tile_flags(tmx.tile_properties.get(gid, {}))
+        
+        # tiles are cut from the tileset images as for a compiled level,
+        # rather than taken from pytmx in whatever format the display has
+        self.images = None
+        if images:
+            self.images = self.cut()
+        
+        # get key count
+        self.keys = int(numpy.count_nonzero(self.table[self.layers[0]] & KEY))
+        
+        # flags OR'd together per tile across visible layers
+        self.flags = numpy.zeros((self.h, self.w), numpy.uint8)
+        for layer in self.layers:
+            self.flags |= self.table[layer]
+        self.flags.setflags(write=False)
+    
+    def write(self, out):
+        sections = []
+        for firstgid, tw, th, margin, spacing, cols, src in self.tilesets:
+            src = src.encode('utf-8')
+            rec = LEVEL_TILESET.pack(firstgid, tw, th, margin, spacing, cols,
+                len(src)) + src
+            sections += [rec]
+        sections += [self.tiled.astype('<u4').tostring(),
+            self.xform.tostring(), self.table.tostring(),
+            numpy.array(self.spawns, '<f4').tostring()]
+        sections += [layer.astype('<u2').tostring() for layer in self.layers]
+        sections += [self.flags.tostring()]
+        head = LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION,
+            len(self.tilesets), self.w, self.h, self.tw, self.th,
+            len(self.layers), len(self.spawns), len(self.table), self.keys,
+            *self.source)
+        with open(out, 'wb') as f:
+            f.write(head)
+            for s in sections:
+                f.write(s + '\0' * (align(len(s)) - len(s)))
+    
+    def read(self, fn, images=True):
+        # no parsing: the header is unpacked and the rest is viewed in place
+        # plain arrays over the mapping, slicing a memmap costs a lot more
+        data = numpy.memmap(fn, numpy.uint8, 'r').view(numpy.ndarray)
+        (magic, version, ntilesets, self.w, self.h, self.tw, self.th,
+            nlayers, nspawns, ngids, self.keys, mtime, size
+        ) = LEVEL_HEADER.unpack(data[:LEVEL_HEADER.size].tostring())
+        self.source = (mtime, size)
+        o = LEVEL_HEADER.size
+        
+        def section(dtype, n):
+            a = data[o:o + n * numpy.dtype(dtype).itemsize].view(dtype)
+            return a, o + align(a.nbytes)
+        
+        self.tilesets = []
+        for i in xrange(ntilesets):
+            rec = LEVEL_TILESET.unpack(data[o:o + LEVEL_TILESET.size].tostring())
+            n = LEVEL_TILESET.size + rec[-1]
+            src = data[o + LEVEL_TILESET.size:o + n].tostring().decode('utf-8')
+            self.tilesets += [rec[:-1] + (src,)]
+            o += align(n)
+        self.tiled, o = section('<u4', ngids)
+        self.xform, o = section(numpy.uint8, ngids)
+        self.table, o = section(numpy.uint8, ngids)
+        spawns, o = section('<f4', nspawns * 2)
+        self.spawns = [tuple(p) for p in spawns.reshape(-1, 2).tolist()]
+        self.layers = []
+        for i in xrange(nlayers):
+            layer, o = section('<u2', self.w * self.h)
+            self.layers += [layer.reshape(self.h, self.w)]
+        flags, o = section(numpy.uint8, self.w * self.h)
+        self.flags = flags.reshape(self.h, self.w)
+        
+        self.images = None
+        if images:
+            self.images = self.cut()
+    
+    def sheets(self):
+        # paths of the tileset images
+        return [os.path.normpath(os.path.join(os.path.dirname(self.fn), ts[-1]))
+            for ts in self.tilesets]
+    
+    def cut(self, images=()):
+        # tile images cut straight out of the tileset images, for the gids
+        # past those already in images
+        sheets = [load_image(fn) for fn in self.sheets()]
+        images = list(images) + [None] * (len(self.tiled) - len(images))
+        for gid, tiled in enumerate(self.tiled.tolist()):
+            if not tiled or images[gid]:
+                continue
+            i = max(j for j, ts in enumerate(self.tilesets) if ts[0] <= tiled)
+            firstgid, tw, th, margin, spacing, cols = self.tilesets[i][:-1]
+            n = tiled - firstgid
+            img = sheets[i].subsurface(margin + (n % cols) * (tw + spacing),
+                margin + (n / cols) * (th + spacing), tw, th).copy()
+            xf = self.xform[gid]
+            if xf & FLIP_D:
+                img = pygame.transform.flip(pygame.transform.rotate(img, 270), 1, 0)
+            if xf & (FLIP_H | FLIP_V):
+                img = pygame.transform.flip(img, bool(xf & FLIP_H), bool(xf & FLIP_V))
+            img.set_colorkey(TRANS, pygame.RLEACCEL)
+            images[gid] = img
+        return images
+    
+    def cell(self, x, y, taken=()):
+        # flags of a tile with the keys in taken removed
+        f = 0
+        for i, layer in enumerate(self.layers):
+            if i == 0 and (x, y) in taken:
+                continue
+            f |= self.table[layer[y, x]]
+        return f
+        
+    def chunk(self, cx, cy):
+        # a chunk's surface, baked if it isn't cached; None if it's empty
+        key = (cx, cy)
+        surface = self.chunks.pop(key, False)
+        if surface is False:
+            surface = self.bake(cx, cy)
+            self.cached += self.cost(surface)
+            while self.cached > CHUNK_BUDGET and self.chunks:
+                self.cached -= self.cost(self.chunks.popitem(last=False)[1])
+        self.chunks[key] = surface
+        return surface
+    
+    def warm(self, cx0, cy0, cx1, cy1):
+        # bake one chunk of a range that isn't cached yet, so a level is
+        # rendered ahead of the camera a frame at a time; True if it did
+        for cy in xrange(max(0, cy0), min(cy1, (self.h - 1) / CHUNK) + 1):
+            for cx in xrange(max(0, cx0), min(cx1, (self.w - 1) / CHUNK) + 1):
+                if (cx, cy) not in self.chunks:
+                    self.chunk(cx, cy)
+                    return True
+        return False
+    
+    def cost(self, surface):
+        # an empty chunk still takes its slot in the cache
+        if not surface:
+            return 256
+        return surface.get_pitch() * surface.get_height()
+    
+    def bake(self, cx, cy, taken=()):
+        tw = self.tw
+        th = self.th
+        x0 = cx * CHUNK
+        y0 = cy * CHUNK
+        w = min(CHUNK, self.w - x0)
+        h = min(CHUNK, self.h - y0)
+        surface = None
+        for i, layer in enumerate(self.layers):
+            for y in xrange(y0, y0 + h):
+                row = layer[y, x0:x0 + w].tolist()
+                for x in xrange(x0, x0 + w):
+                    img = self.images[row[x - x0]]
+                    if not img or (i == 0 and (x, y) in taken):
+                        continue
+                    if not surface:
+                        surface = blank((w*tw, h*th))
+                        surface.fill(TRANS)
+                    surface.blit(img, ((x-x0)*tw, (y-y0)*th))
+        if surface:
+            surface.set_colorkey(TRANS, pygame.RLEACCEL)
+        return surface
+    
+    def diff(self, other):
+        # tiles that look or act differently in other, a later parse of the
+        # same map; None if the two don't line up tile for tile
+        if ((other.w, other.h, other.tw, other.th, len(other.layers)) !=
+                (self.w, self.h, self.tw, self.th, len(self.layers))):
+            return None
+        changed = self.flags != other.flags
+        for a, b in zip(self.layers, other.layers):
+            changed |= self.tiled[a] != other.tiled[b]
+            changed |= self.xform[a] != other.xform[b]
+        return changed
+    
+    def adopt(self, other, changed):
+        # become other in place, so everything holding this level sees the
+        # edit, keeping the chunks of tiles that didn't change
+        for k in ('w', 'h', 'tw', 'th', 'sz', 'spawns', 'layers', 'tilesets',
+                'tiled', 'xform', 'table', 'keys', 'flags', 'source', 'images'):
+            setattr(self, k, getattr(other, k))
+        if changed is None:
+            self.chunks.clear()
+            self.cached = 0
+            return
+        ys, xs = numpy.nonzero(changed)
+        for key in set(zip((xs / CHUNK).tolist(), (ys / CHUNK).tolist())):
+            if key in self.chunks:
+                self.cached -= self.cost(self.chunks.pop(key))
+    
+    def edit(self, fn, skeleton):
+        # this level with the tile layers of fn, read without pytmx, if
+        # they're all that changed since the tmx was skeleton; else None
+        tmx = tmx_skeleton(fn)
+        if not tmx or tmx[0] != skeleton:
+            return None
+        # tmx gids carry flips in their top bits, look each one up; a tile
+        # or flip the map didn't use yet gets the next gid
+        tiled = self.tiled.tolist()
+        xform = self.xform.tolist()
+        table = self.table.tolist()
+        gids = dict(((t, x), gid) for gid, (t, x) in enumerate(zip(tiled, xform)) if t)
+        gids[(0, 0)] = 0
+        tiles = tmx[2]
+        layers = []
+        for raw in tmx[1]:
+            if raw.size != self.w * self.h:
+                return None
+            vals, inv = numpy.unique(raw, return_inverse=True)
+            lut = []
+            for v in vals.tolist():
+                xf = (((v >> 31) & 1 and FLIP_H) | ((v >> 30) & 1 and FLIP_V) |
+                    ((v >> 29) & 1 and FLIP_D))
+                key = (v & 0x1fffffff, xf)
+                gid = gids.get(key)
+                if gid is None:
+                    if key[0] not in tiles:
+                        return None
+                    gid = gids[key] = len(tiled)
+                    tiled += [key[0]]
+                    xform += [xf]
+                    table += [tiles[key[0]]]
+                lut += [gid]
+            layers += [numpy.array(lut, numpy.uint16)[inv].reshape(self.h, self.w)]
+        new = copy.copy(self)
+        if len(tiled) > len(self.tiled):
+            new.tiled = numpy.array(tiled, numpy.uint32)
+            new.xform = numpy.array(xform, numpy.uint8)
+            new.table = numpy.array(table, numpy.uint8)
+            if self.images:
+                new.images = new.cut(self.images)
+        new.layers = layers
+        new.flags = numpy.zeros((self.h, self.w), numpy.uint8)
+        for layer in layers:
+            new.flags |= new.table[layer]
+        new.flags.setflags(write=False)
+        new.keys = int(numpy.count_nonzero(new.table[layers[0]] & KEY))
+        st = os.stat(fn)
+        new.source = (st.st_mtime, st.st_size)
+        return new
 
+def tmx_skeleton(fn):
+    # a tmx as its text without tile data, the data of each visible tile
+    # layer, and the flags of every tile its tilesets hold by tiled gid;
+    # None unless every layer is plain csv
+    import xml.etree.cElementTree as ET
+    try:
+        root = ET.parse(fn).getroot()
+    except (IOError, SyntaxError):
+        return None
+    layers = []
+    for layer in root.findall('layer'):
+        data = layer.find('data')
+        if data is None or data.get('encoding') != 'csv' or data.get('compression'):
+            return None
+        if layer.get('visible', '1') != '0':
+            layers += [numpy.fromstring(data.text or '', numpy.int64, sep=',')]
+        data.text = None
+    tiles = {}
+    for ts in root.findall('tileset'):
+        img = ts.find('image')
+        if img is None:
+            # an external tsx, its tiles are only known to pytmx
+            continue
+        tw, th = int(ts.get('tilewidth')), int(ts.get('tileheight'))
+        margin, spacing = int(ts.get('margin', 0)), int(ts.get('spacing', 0))
+        cols = (int(img.get('width')) - 2*margin + spacing) / (tw + spacing)
+        rows = (int(img.get('height')) - 2*margin + spacing) / (th + spacing)
+        props = dict((int(tile.get('id')),
+            set(p.get('name') for p in tile.iter('property')))
+            for tile in ts.findall('tile'))
+        firstgid = int(ts.get('firstgid'))
+        for i in xrange(cols * rows):
+            tiles[firstgid + i] = tile_flags(props.get(i, ()))
+    return ET.tostring(root), layers, tiles
 
-        # get key count
-        for row in self.tmx.layers[0].data:
-            for gid in row:
-                if gid not in self.tmx.tile_properties:
+class Streamer:
+    # loads the map after the one being played on a worker thread, so a
+    # level change only swaps it in and a missing one is known beforehand
+    def __init__(self):
+        self.fn = None
+        self.thread = None
+        self.result = None
+    
+    def fetch(self, fn):
+        if fn == self.fn:
+            return
+        if self.thread:
+            self.thread.join()
+        self.fn = fn
+        self.result = None
+        self.thread = threading.Thread(target=self.work, args=(fn,), name='stream')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def work(self, fn):
+        try:
+            self.result = Level(fn)
+        except NoSuchLevel as e:
+            self.result = e
+    
+    def take(self, fn):
+        # the prefetched level, None if fn wasn't fetched
+        if fn != self.fn:
+            return None
+        self.thread.join()
+        result = self.result
+        self.fn = self.thread = self.result = None
+        if isinstance(result, NoSuchLevel):
+            raise result
+        return result
+
+class Watcher:
+    # polls the mtimes of the maps and graphics once a frame and patches
+    # edits into the running game: levels tile by tile, images in place
+    def __init__(self, game, paths=('./data/maps', './data/gfx')):
+        self.game = game
+        self.paths = paths
+        self.stats = self.scan()
+        self.skeletons = {} # each loaded level's tmx less its tile data
+        self.parsing = {} # tmx edited beyond tiles, parsed on a worker
+    
+    def scan(self):
+        stats = {}
+        for path in self.paths:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                fn = os.path.normpath(os.path.join(path, name))
+                try:
+                    st = os.stat(fn)
+                except OSError:
                     continue
-                props  = self.tmx.tile_properties[gid]
-                if 'key' in props:
-                    self.keys += 1
+                stats[fn] = (st.st_mtime, st.st_size)
+        return stats
+    
+    def poll(self):
+        stats = self.scan()
+        edited = sorted(fn for fn, st in stats.iteritems()
+            if self.stats.get(fn) != st)
+        self.stats = stats
+        # a copy, the warm-up thread may still be adding to it
+        levels = dict((os.path.normpath(fn), level)
+            for fn, level in list(self.game.levels.items()))
+        # what a level's tmx was when it loaded, to tell tile edits apart
+        for fn, level in levels.iteritems():
+            if fn in self.skeletons:
+                continue
+            if stats.get(fn) == level.source:
+                tmx = tmx_skeleton(fn)
+                self.skeletons[fn] = tmx and tmx[0]
+            else:
+                self.skeletons[fn] = None
+                edited += [fn]
+        
+        for fn in edited:
+            ext = os.path.splitext(fn)[1].lower()
+            if ext == '.tmx':
+                # the next level may have been loaded before the edit
+                streamer = self.game.streamer
+                if streamer.fn and os.path.normpath(streamer.fn) == fn:
+                    prefetched, streamer.fn = streamer.fn, None
+                    streamer.fetch(prefetched)
+                if fn in levels:
+                    self.edit(fn, levels[fn])
+            elif ext == '.png':
+                self.image(fn, levels)
+        
+        for fn, (streamer, t) in self.parsing.items():
+            if streamer.thread.is_alive():
+                continue
+            del self.parsing[fn]
+            try:
+                new = streamer.take(streamer.fn)
+            except NoSuchLevel:
+                # caught half written, the save that finishes it is next
+                continue
+            tmx = tmx_skeleton(fn)
+            self.skeletons[fn] = tmx and tmx[0]
+            self.apply(fn, levels[fn], new, t)
+    
+    def edit(self, fn, level):
+        t = time.time()
+        new = None
+        if self.skeletons.get(fn):
+            new = level.edit(fn, self.skeletons[fn])
+        if new:
+            self.apply(fn, level, new, t)
+            return
+        # anything but the tiles needs pytmx, too slow to run on a frame
+        streamer = Streamer()
+        streamer.fetch(fn)
+        self.parsing[fn] = (streamer, t)
+    
+    def apply(self, fn, level, new, t):
+        changed = level.diff(new)
+        level.adopt(new, changed)
+        world = self.game.world
+        if world and world.level is level:
+            world.refresh(changed)
+        print '%s: %s tiles changed in %.1fms' % (fn,
+            'all' if changed is None else numpy.count_nonzero(changed),
+            (time.time() - t) * 1000.0)
+    
+    def image(self, fn, levels):
+        t = time.time()
+        self.game.assets.refresh(fn)
+        world = self.game.world
+        for level in levels.itervalues():
+            if level.images and fn in level.sheets():
+                level.images = level.cut()
+                level.chunks.clear()
+                level.cached = 0
+                if world and world.level is level:
+                    world.chunks = {}
+                    world.refresh(numpy.zeros((level.h, level.w), bool))
+        print '%s: reloaded in %.1fms' % (fn, (time.time() - t) * 1000.0)
+
+class Entities(object):
+    # objects attached to a world: a dense list of the live ones to iterate,
+    # and slots with generation counts so (slot, gen) refs go stale on removal
+    __slots__ = ('live', 'index', 'gens', 'free', 'space')
+    
+    def __init__(self, space=None):
+        self.live = []
+        self.index = [] # slot -> position in live, -1 when free
+        self.gens = []
+        self.free = []
+        self.space = space
+    
+    def __iter__(self):
+        return iter(self.live)
+    
+    def __len__(self):
+        return len(self.live)
+    
+    def add(self, obj):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.index)
+            self.index.append(-1)
+            self.gens.append(0)
+        self.index[slot] = len(self.live)
+        self.live.append(obj)
+        obj.slot = slot
+        obj.gen = self.gens[slot]
+        if self.space:
+            self.space.update(obj)
+    
+    def remove(self, obj):
+        # swap the last live object into the hole
+        i = self.index[obj.slot]
+        last = self.live.pop()
+        if last is not obj:
+            self.live[i] = last
+            self.index[last.slot] = i
+        self.index[obj.slot] = -1
+        self.gens[obj.slot] += 1
+        self.free.append(obj.slot)
+        obj.slot = -1
+        if self.space:
+            self.space.remove(obj)
+    
+    def get(self, slot, gen):
+        if 0 <= slot < len(self.gens) and self.gens[slot] == gen:
+            i = self.index[slot]
+            if i >= 0:
+                return self.live[i]
+        return None
+    
+    def flush(self):
+        # drop detached objects, back to front so swapped in ones are
+        # already checked
+        live = self.live
+        for i in xrange(len(live) - 1, -1, -1):
+            if not live[i].attached:
+                self.remove(live[i])
+
+class Space(object):
+    # uniform grid over the map, one cell per tile, listing the objects
+    # overlapping each cell; update() an object after it moves
+    __slots__ = ('cw', 'ch', 'cells')
+    
+    def __init__(self, cw, ch):
+        self.cw = float(cw)
+        self.ch = float(ch)
+        self.cells = {}
+    
+    def cover(self, x, y, w, h):
+        return (
+            int(math.floor(x / self.cw)), int(math.floor(y / self.ch)),
+            int(math.floor((x + w) / self.cw)), int(math.floor((y + h) / self.ch))
+        )
+    
+    def covers(self, x, y, w, h):
+        # cover for arrays of rects
+        floor = numpy.floor
+        return [a.astype(int) for a in (floor(x / self.cw), floor(y / self.ch),
+            floor((x + w) / self.cw), floor((y + h) / self.ch))]
+    
+    def update(self, obj):
+        span = self.cover(obj.pos.x, obj.pos.y, obj.sz.x, obj.sz.y)
+        if span == obj.span:
+            return
+        self.remove(obj)
+        x0, y0, x1, y1 = span
+        for cy in xrange(y0, y1 + 1):
+            for cx in xrange(x0, x1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    cell = self.cells[(cx, cy)] = []
+                cell.append(obj)
+        obj.span = span
+    
+    def remove(self, obj):
+        if not obj.span:
+            return
+        x0, y0, x1, y1 = obj.span
+        for cy in xrange(y0, y1 + 1):
+            for cx in xrange(x0, x1 + 1):
+                cell = self.cells[(cx, cy)]
+                cell.remove(obj)
+                if not cell:
+                    del self.cells[(cx, cy)]
+        obj.span = None
+    
+    def near(self, x, y, w, h):
+        # objects in the cells a rect covers, each once
+        x0, y0, x1, y1 = self.cover(x, y, w, h)
+        found = []
+        seen = set()
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # fewer occupied cells than cells in the rect
+            cells = [
+                objs for (cx, cy), objs in self.cells.iteritems()
+                if x0 <= cx <= x1 and y0 <= cy <= y1
+            ]
+        else:
+            cells = [
+                self.cells[(cx, cy)]
+                for cy in xrange(y0, y1 + 1) for cx in xrange(x0, x1 + 1)
+                if (cx, cy) in self.cells
+            ]
+        for objs in cells:
+            for obj in objs:
+                if id(obj) not in seen:
+                    seen.add(id(obj))
+                    found.append(obj)
+        return found
+    
+    def query(self, x, y, w, h):
+        # objects whose rects overlap a rect
+        return [
+            obj for obj in self.near(x, y, w, h)
+            if obj.pos.x < x + w and x < obj.pos.x + obj.sz.x
+            and obj.pos.y < y + h and y < obj.pos.y + obj.sz.y
+        ]
+    
+    def radius(self, x, y, r):
+        # objects whose rects come within r of a point
+        found = []
+        for obj in self.near(x - r, y - r, 2 * r, 2 * r):
+            dx = x - max(obj.pos.x, min(x, obj.pos.x + obj.sz.x))
+            dy = y - max(obj.pos.y, min(y, obj.pos.y + obj.sz.y))
+            if dx * dx + dy * dy <= r * r:
+                found.append(obj)
+        return found
+
+class Bullets:
+    # all of a world's bullets, as arrays of positions and velocities
+    # updated together; dead slots are reused
+    def __init__(self, world, n=64):
+        self.world = world
+        self.surface = world.game.assets.image('./data/gfx/bullet.png')
+        w, h = self.surface.get_size()
+        self.sz = numpy.array([w, h], float)
+        self.pos = numpy.zeros((n, 2))
+        self.prev = numpy.zeros((n, 2))
+        self.vel = numpy.zeros((n, 2))
+        self.alive = numpy.zeros(n, bool)
+        self.owner = [None] * n
+        self.free = range(n-1, -1, -1)
+        self.count = 0
+    
+    def grow(self):
+        n = len(self.alive)
+        self.pos = numpy.concatenate((self.pos, numpy.zeros((n, 2))))
+        self.prev = numpy.concatenate((self.prev, numpy.zeros((n, 2))))
+        self.vel = numpy.concatenate((self.vel, numpy.zeros((n, 2))))
+        self.alive = numpy.concatenate((self.alive, numpy.zeros(n, bool)))
+        self.owner += [None] * n
+        self.free = range(2*n-1, n-1, -1) + self.free
+    
+    def spawn(self, x, y, vx, vy, owner=None):
+        if not self.free:
+            self.grow()
+        i = self.free.pop()
+        self.pos[i] = self.prev[i] = (x, y)
+        self.vel[i] = (vx, vy)
+        self.alive[i] = True
+        self.owner[i] = owner
+        self.count += 1
+        return i
+    
+    def kill(self, dead):
+        self.alive[dead] = False
+        self.vel[dead] = 0.0
+        idx = numpy.flatnonzero(dead).tolist()
+        for i in idx:
+            self.owner[i] = None
+        self.free += idx
+        self.count -= len(idx)
+    
+    def logic(self, t):
+        if not self.count:
+            return
+        # every slot is moved, dead ones have no velocity so stay put
+        a = self.alive
+        self.prev[...] = self.pos
+        self.pos += self.vel * t
+        
+        # out of the world, or centre inside a solid tile
+        level = self.world.level
+        x = self.pos[:, 0]
+        y = self.pos[:, 1]
+        inside = a & (x >= 0) & (x < level.sz.x) & (y >= 0) & (y < level.sz.y)
+        tx = ((x + self.sz[0] / 2.0) / level.tw).astype(int)
+        ty = ((y + self.sz[1] / 2.0) / level.th).astype(int)
+        numpy.clip(tx, 0, level.w - 1, tx)
+        numpy.clip(ty, 0, level.h - 1, ty)
+        inside &= (self.world.at(tx, ty) & SOLID) == 0
+        dead = a & ~inside
+        
+        # only bullets covering a cell some object occupies can hit anything
+        space = self.world.space
+        if space.cells:
+            occupied = numpy.array([cx + (cy << 16) for cx, cy in space.cells])
+            w, h = self.sz
+            x0, y0, x1, y1 = space.covers(x, y, w, h)
+            near = numpy.zeros(len(a), bool)
+            for dy in xrange(int(math.ceil(h / space.ch)) + 1):
+                for dx in xrange(int(math.ceil(w / space.cw)) + 1):
+                    cells = numpy.minimum(x0 + dx, x1) + (numpy.minimum(y0 + dy, y1) << 16)
+                    near |= numpy.in1d(cells, occupied)
+            near &= inside
+            for i in numpy.flatnonzero(near).tolist():
+                x, y = self.pos[i]
+                for obj in space.query(x, y, w, h):
+                    if obj.attached and obj.hit(self.owner[i]):
+                        dead[i] = True
+                        break
+        if dead.any():
+            self.kill(dead)
+    
+    def render(self, view, alpha):
+        if not self.count:
+            return
+        a = self.alive
+        pos = self.prev[a] + (self.pos[a] - self.prev[a]) * alpha
+        pos -= (view.x, view.y)
+        w, h = self.sz
+        on = (pos[:, 0] > -w) & (pos[:, 0] < SCREEN_W)
+        on &= (pos[:, 1] > -h) & (pos[:, 1] < SCREEN_H)
+        surface = self.surface
+        pos = pos[on].astype(int).tolist()
+        self.world.game.screen.buf.blits([(surface, p) for p in pos], 0)
+        self.world.game.prof.count('blits', len(pos))
+
+class World:
+    # per-attempt state on top of a Level: collected keys, objects, time
+    def __init__(self, level, game):
+        self.level = level
+        self.game = game
+        self.sz = level.sz
+        self.spawns = level.spawns
+        self.keys = level.keys
+        self.space = Space(level.tw, level.th)
+        self.objects = Entities(self.space)
+        self.bullets = Bullets(self)
+        
+        # the level's, with the cells and chunks keys were taken from
+        # patched over the top
+        self.flags = level.flags
+        self.patch = {}
+        self.chunks = {}
+        self.taken = set()
 
         self.next_level = False
         self.time = 0
         
     def attach(self, obj):
         if not obj.attached:
-            self.objects += [obj]
+            self.objects.add(obj)
             obj.attached = True
     
-    def tile_below(self, obj):
-        center = obj.pos + obj.sz/2.0
-        try:
-            tx = int(round(center.x/self.tmx.tilewidth)) * self.tmx.tilewidth
-            ty = int(round(center.x/self.tmx.tilewidth)) * self.tmx.tileheight
-            t = self.tmx.get_tile_image(
-                int(round(center.x/self.tmx.tilewidth)),
-                int(round(center.y/self.tmx.tileheight)),
-                0
-            )
-            if t:
-                o = Object(
-                    pos=(tx,ty),
-                    sz=(self.tmx.tilewidth, self.tmx.tileheight)
-                )
-                o.tile = t
-                return o
-        except:
-            pass
-        return None
-        
     def collision(self, obj):
-        potentials = []
-        obj_rect = pygame.Rect(obj.pos.x, obj.pos.y, obj.sz.x, obj.sz.y)
-        tw = self.tmx.tilewidth
-        th = self.tmx.tileheight
-        f2i = lambda n: int(round(n))
-        x_inc = min(tw, int(obj.sz.x))
-        y_inc = min(th, int(obj.sz.y))
+        tw = float(self.level.tw)
+        th = float(self.level.th)
+        x0 = max(0, int(math.floor(obj.pos.x / tw)))
+        y0 = max(0, int(math.floor(obj.pos.y / th)))
+        sz = obj.box or obj.sz
+        x1 = min(self.level.w, int(math.ceil((obj.pos.x + sz.x) / tw)))
+        y1 = min(self.level.h, int(math.ceil((obj.pos.y + sz.y) / th)))
         obj.by_ladder = False
+        self.game.prof.count('collision')
+        if x0 >= x1 or y0 >= y1:
+            return False
+        return self.touch(obj, x0, y0, x1, y1)
+    
+    def sweep(self, obj, dx, dy):
+        # move obj along one axis until it meets a solid tile, applying the
+        # triggers of every tile passed over or run into;
+        # returns the contact normal along that axis, or 0
+        self.game.prof.count('collision')
+        sz = obj.box or obj.sz
+        if dy:
+            step, cross = float(self.level.th), float(self.level.tw)
+            pos, size, d = obj.pos.y, sz.y, dy
+            a, asz = obj.pos.x, sz.x
+            n, m = self.level.h, self.level.w
+        else:
+            step, cross = float(self.level.tw), float(self.level.th)
+            pos, size, d = obj.pos.x, sz.x, dx
+            a, asz = obj.pos.y, sz.y
+            n, m = self.level.w, self.level.h
+        lo = max(0, int(math.floor(a / cross)))
+        hi = min(m, int(math.ceil((a + asz) / cross)))
         
-        for y in range(int(obj.pos.y), int(obj.pos.y + obj.sz.y), y_inc):
-            for x in range(int(obj.pos.x), int(obj.pos.x + obj.sz.x), x_inc):
-                if x < 0 or x >= self.sz.x or y < 0 or y >= self.sz.y:
-                    continue
-                #try:
-                for i in self.tmx.visible_tile_layers:
-                    t = self.tmx.get_tile_image(x/tw, y/th, i)
-                    props = self.tmx.get_tile_properties(x/tw, y/th, i)
-                    exit = True if props and 'exit' in props else False
-                    ladder = True if props and 'ladder' in props else False
-                    obj.by_ladder = ladder
-                    kill = True if props and 'kill' in props else False
-                    key = True if props and 'key' in props else False
-                    if key:
-                        if obj.give('key'):
-                            self.tmx.layers[0].data[y/th][x/tw] = 0
-                            self.keys -= 1
-                    if kill:
-                        obj.attached = False
-                    if exit:
-                        if self.keys == 0:
-                            self.next_level = True
-                        else:
-                            obj.attached = False
-                    if t and not ladder:
-                        return True
-                        #print t
-                        #potentials += [pygame.Rect(x/tw*tw, y/th*th, tw, th)]
-                #except:
-                #    pass
+        # lines of tiles the leading edge enters
+        if d > 0:
+            c0 = max(0, int(math.ceil((pos + size) / step)))
+            c1 = min(n, int(math.ceil((pos + size + d) / step)))
+        else:
+            c0 = max(0, int(math.floor((pos + d) / step)))
+            c1 = min(n, int(math.floor(pos / step)))
+        new = pos + d
+        normal = 0
+        if lo < hi and c0 < c1:
+            if dy:
+                cells = self.region(lo, c0, hi, c1).T
+            else:
+                cells = self.region(c0, lo, c1, hi)
+            lines = numpy.bitwise_or.reduce(cells, axis=0)
+            hits = numpy.flatnonzero(lines & SOLID)
+            if hits.size:
+                normal = -sgn(d)
+                if d > 0:
+                    c = c0 + int(hits[0])
+                    new = c * step - size
+                else:
+                    c = c0 + int(hits[-1])
+                    new = (c + 1) * step
         
-        #return potentials
-        #b = obj_rect.collidelist(potentials)
-        #print b
-        #return b != -1
+        # everything between the start and end position, plus the line hit
+        t0 = int(math.floor(min(pos, new) / step))
+        t1 = int(math.ceil((max(pos, new) + size) / step))
+        if normal < 0:
+            t1 += 1
+        elif normal > 0:
+            t0 -= 1
+        t0 = max(0, t0)
+        t1 = min(n, t1)
         
-        #print 'none'
-        #return False
+        if dy:
+            obj.pos.y = new
+            if lo < hi and t0 < t1:
+                self.touch(obj, lo, t0, hi, t1)
+        else:
+            obj.pos.x = new
+            if lo < hi and t0 < t1:
+                self.touch(obj, t0, lo, t1, hi)
+        return normal
+    
+    def region(self, x0, y0, x1, y1):
+        # flags of a block of tiles
+        cells = self.flags[y0:y1, x0:x1]
+        copied = False
+        for (x, y), f in self.patch.iteritems():
+            if x0 <= x < x1 and y0 <= y < y1:
+                if not copied:
+                    cells = cells.copy()
+                    copied = True
+                cells[y - y0, x - x0] = f
+        return cells
+    
+    def at(self, tx, ty):
+        # flags of the tiles at arrays of coordinates
+        f = self.flags[ty, tx]
+        for (x, y), v in self.patch.iteritems():
+            f[(tx == x) & (ty == y)] = v
+        return f
+    
+    def touch(self, obj, x0, y0, x1, y1):
+        cells = self.region(x0, y0, x1, y1)
+        f = numpy.bitwise_or.reduce(cells, axis=None)
+        if f & LADDER:
+            obj.by_ladder = True
+        if f & KEY:
+            for y, x in numpy.argwhere(cells & KEY):
+                if obj.give('key'):
+                    self.take(int(x0 + x), int(y0 + y))
+        if f & KILL:
+            obj.attached = False
+        if f & EXIT:
+            if self.keys == 0:
+                self.next_level = True
+            else:
+                obj.attached = False
+        return bool(f & SOLID)
+    
+    def refresh(self, changed):
+        # after the level was edited in place: keys taken from tiles the
+        # edit changed come back as whatever is there now
+        level = self.level
+        self.sz = level.sz
+        self.spawns = level.spawns
+        self.flags = level.flags
+        if changed is None:
+            self.taken = set()
+            dirty = set()
+        else:
+            self.taken = set((x, y) for x, y in self.taken if not changed[y, x])
+            ys, xs = numpy.nonzero(changed)
+            dirty = set(zip((xs / CHUNK).tolist(), (ys / CHUNK).tolist()))
+        self.patch = dict(((x, y), level.cell(x, y, self.taken))
+            for x, y in self.taken)
+        old = self.chunks
+        self.chunks = {}
+        for x, y in self.taken:
+            key = (x / CHUNK, y / CHUNK)
+            if key in old and key not in dirty:
+                self.chunks[key] = old[key]
+            elif key not in self.chunks:
+                self.chunks[key] = level.bake(key[0], key[1], self.taken)
+        self.keys = level.keys - len(self.taken)
+    
+    def take(self, x, y):
+        self.taken.add((x, y))
+        self.patch[(x, y)] = self.level.cell(x, y, self.taken)
+        self.chunks[(x / CHUNK, y / CHUNK)] = self.level.bake(x / CHUNK, y / CHUNK, self.taken)
+        self.keys -= 1
         
     def logic(self, t):
         r = False
@@ -438,64 +1725,415 @@ class World:
         self.time += t
         
         if r:
+            if self.game.effects:
+                self.game.screen.fade()
             self.game.reset()
         
     def render(self, view):
-        tw = self.tmx.tilewidth
-        th = self.tmx.tileheight
-        for layer in self.tmx.visible_layers:
-            if isinstance(layer, pytmx.TiledTileLayer):
-                for x, y, img in layer.tiles():
-                    self.game.screen.buf.blit(img, (x*tw-view.x, y*th-view.y))
-
-        for obj in self.objects:
+        cw = CHUNK * self.level.tw
+        ch = CHUNK * self.level.th
+        # same pixel snapping as blitting each tile at a float offset
+        vx = int(math.ceil(view.x))
+        vy = int(math.ceil(view.y))
+        x0 = vx / cw
+        y0 = vy / ch
+        x1 = min((vx + SCREEN_W - 1) / cw, (self.level.w - 1) / CHUNK)
+        y1 = min((vy + SCREEN_H - 1) / ch, (self.level.h - 1) / CHUNK)
+        prof = self.game.prof
+        for cy in xrange(max(0, y0), y1 + 1):
+            for cx in xrange(max(0, x0), x1 + 1):
+                surface = self.chunks.get((cx, cy), False)
+                if surface is False:
+                    surface = self.level.chunk(cx, cy)
+                if surface:
+                    self.game.screen.buf.blit(surface, (cx*cw-vx, cy*ch-vy))
+                    prof.count('blits')
+        # and the chunks just out of view, before they're needed
+        if self.level.warm(x0 - 1, y0 - 1, x1 + 1, y1 + 1):
+            prof.count('baked')
+
+        # a tile of margin for objects drawn between steps
+        tw = self.level.tw
+        th = self.level.th
+        objs = self.space.query(view.x - tw, view.y - th, SCREEN_W + 2*tw, SCREEN_H + 2*th)
+        for obj in objs:
             obj.render(view)
+        prof.count('blits', len(objs))
+        self.bullets.render(view, self.game.alpha)
         
 def snap(pos):
     return (int(round(pos[0])), int(round(pos[1])))
 
-class Game:
-    def __init__(self):
+def key_code(name):
+    # pygame key constant from a name like 'right', 'space' or 'j'
+    code = getattr(pygame, 'K_' + name, None)
+    if code is None:
+        code = getattr(pygame, 'K_' + name.upper())
+    return code
 
-        pygame.init()
-        pygame.mixer.init(channels=8)
-        #pygame.mixer.music.load(os.path.join(os.path.expanduser("~"), "mus2.mp3"))
+class Script:
+    # scripted input, one collection of held keys per simulation step,
+    # handed to Game as the key events a player would have produced
+    def __init__(self, frames):
+        self.frames = iter(frames)
+        self.held = set()
+    
+    joys = []
+    
+    @staticmethod
+    def load(fn):
+        # lines of "<steps> [key ...]", e.g. "30 right up"
+        frames = []
+        with open(fn) as f:
+            for line in f:
+                line = line.split('#')[0].split()
+                if line:
+                    keys = [key_code(k) for k in line[1:]]
+                    frames += [keys] * int(line[0])
+        return Script(frames)
+    
+    def events(self):
+        try:
+            keys = set(next(self.frames))
+        except StopIteration:
+            return [pygame.event.Event(pygame.QUIT)]
+        evs = [pygame.event.Event(pygame.KEYUP, key=k) for k in self.held - keys]
+        evs += [pygame.event.Event(pygame.KEYDOWN, key=k) for k in keys - self.held]
+        self.held = keys
+        return evs
+
+# keys the game reacts to, as bits in recorded input
+KEYMAP = [
+    pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN,
+    pygame.K_j, pygame.K_l, pygame.K_i, pygame.K_SPACE,
+    pygame.K_r, pygame.K_q, pygame.K_PAGEUP
+]
+KEYBIT = dict((k, 1 << i) for i, k in enumerate(KEYMAP))
+# events after which the window has to be presented in full again
+EXPOSE = (pygame.VIDEOEXPOSE, pygame.ACTIVEEVENT)
+REPLAY_MAGIC = 'GBRP'
+REPLAY_VERSION = 2
+# after the last record, a run of 0 and where the recorded game ended up
+REPLAY_END = struct.Struct('<IBddd')
+
+def keymask(keys):
+    m = 0
+    for k in keys:
+        m |= KEYBIT.get(k, 0)
+    return m
+
+def varint(n):
+    s = ''
+    while n >= 0x80:
+        s += chr(n & 0x7f | 0x80)
+        n >>= 7
+    return s + chr(n)
+
+class JoyState:
+    # a recorded joystick, answering the calls Guy.interface makes
+    def __init__(self, hats):
+        self.hats = hats
+        self.axes = (0.0, 0.0)
+        self.hat = (0, 0)
+        self.buttons = 0
+    
+    def get_axis(self, i):
+        if JOY_AXIS <= i <= JOY_AXIS + 1:
+            return self.axes[i - JOY_AXIS]
+        return 0.0
+    
+    def get_numhats(self):
+        return self.hats
+    
+    def get_hat(self, i):
+        return self.hat
+    
+    def get_button(self, i):
+        return (self.buttons >> i) & 1
+
+class Recorder:
+    # input for each GAME step, run-length encoded as it's captured:
+    # a header, then records of <varint run><state>, where a state is the
+    # keys pressed this step and held after it, then per joystick the two
+    # movement axes, hat 0 and the button bits; closed with a run of 0 and
+    # the steps, mode, guy position and time it ended on, to check against
+    def __init__(self, fn, game):
+        # joysticks are probed after the title shows, so the header waits
+        # for the first step
+        self.fn = fn
+        self.game = game
+        self.f = None
+        self.state = None
+        self.run = 0
+        self.steps = 0
+    
+    def open(self):
+        game = self.game
+        self.f = open(self.fn, 'wb')
+        self.fmt = '<HH' + 'hhbbH' * len(game.joys)
+        level = str(game.level)
+        self.f.write(REPLAY_MAGIC + struct.pack('<BIHB',
+            REPLAY_VERSION, game.seed, int(round(1.0 / game.dt)), len(game.joys)))
+        self.f.write(struct.pack('<B', len(level)) + level)
+        for joy in game.joys:
+            self.f.write(struct.pack('<B', joy.get_numhats()))
+    
+    def capture(self, game, down):
+        if not self.f:
+            self.open()
+        state = [down, keymask(game.keys)]
+        for joy in game.joys:
+            hat = joy.get_hat(0) if joy.get_numhats() else (0, 0)
+            buttons = 0
+            for i in xrange(min(16, joy.get_numbuttons())):
+                buttons |= joy.get_button(i) << i
+            state += [
+                # pygame reports axes as raw/32768
+                max(-32768, min(32767, int(round(joy.get_axis(JOY_AXIS) * 32768)))),
+                max(-32768, min(32767, int(round(joy.get_axis(JOY_AXIS+1) * 32768)))),
+                hat[0], hat[1], buttons
+            ]
+        state = struct.pack(self.fmt, *state)
+        self.steps += 1
+        if state == self.state:
+            self.run += 1
+            return
+        self.write()
+        self.state = state
+        self.run = 1
+    
+    def write(self):
+        if self.run:
+            self.f.write(varint(self.run) + self.state)
+            self.f.flush()
+    
+    def close(self):
+        if not self.f:
+            self.open()
+        self.write()
+        self.run = 0
+        level = str(self.game.level)
+        self.f.write(varint(0) + REPLAY_END.pack(self.steps, self.game.mode,
+            *ending(self.game)) + chr(len(level)) + level)
+        self.f.close()
+
+def ending(game):
+    # where a game stands, to tell whether a replay of it went the same way
+    if game.mode != game.GAME:
+        return 0.0, 0.0, 0.0
+    return game.guy.pos.x, game.guy.pos.y, game.world.time
+
+class Replay:
+    # plays a Recorder stream back as key events and joystick state
+    def __init__(self, fn):
+        self.f = open(fn, 'rb')
+        if self.f.read(4) != REPLAY_MAGIC:
+            raise ValueError('%s is not a replay' % fn)
+        version, self.seed, self.rate, joys = struct.unpack('<BIHB', self.f.read(8))
+        if version != REPLAY_VERSION:
+            raise ValueError('unsupported replay version %d' % version)
+        n = ord(self.f.read(1))
+        self.level = level_name(self.f.read(n))
+        self.joys = [JoyState(ord(self.f.read(1))) for i in xrange(joys)]
+        self.fmt = '<HH' + 'hhbbH' * joys
+        self.size = struct.calcsize(self.fmt)
+        self.state = None
+        self.run = 0
+        self.held = 0
+        self.steps = 0
+        self.end = None # what the recording ended on, once that's read
+    
+    def next(self):
+        if not self.run:
+            if self.end:
+                return None
+            n = shift = 0
+            while True:
+                c = self.f.read(1)
+                if not c:
+                    return None
+                n |= (ord(c) & 0x7f) << shift
+                shift += 7
+                if not ord(c) & 0x80:
+                    break
+            if not n:
+                self.end = REPLAY_END.unpack(self.f.read(REPLAY_END.size))
+                self.end += (level_name(self.f.read(ord(self.f.read(1)))),)
+                return None
+            self.run = n
+            self.state = struct.unpack(self.fmt, self.f.read(self.size))
+        self.run -= 1
+        self.steps += 1
+        return self.state
+    
+    def check(self, game):
+        # None when the game ended where the recording did, else why not
+        if not self.end:
+            return None
+        steps, mode, x, y, t, level = self.end
+        now = (self.steps, game.mode) + ending(game) + (game.level,)
+        if now == self.end:
+            return None
+        return ('%d steps in mode %d, guy at (%r, %r) at %r on level %s; '
+            'recorded %d steps in mode %d, guy at (%r, %r) at %r on level %s' %
+            (now + self.end))
+    
+    def events(self):
+        state = self.next()
+        if state is None:
+            self.f.close()
+            return [pygame.event.Event(pygame.QUIT)]
+        down, held = state[:2]
+        for i, joy in enumerate(self.joys):
+            ax, ay, hx, hy, buttons = state[2+i*5:7+i*5]
+            joy.axes = (ax / 32768.0, ay / 32768.0)
+            joy.hat = (hx, hy)
+            joy.buttons = buttons
+        evs = [pygame.event.Event(pygame.KEYDOWN, key=k) for k in KEYMAP if down & KEYBIT[k]]
+        up = (self.held | down) & ~held
+        evs += [pygame.event.Event(pygame.KEYUP, key=k) for k in KEYMAP if up & KEYBIT[k]]
+        self.held = held
+        return evs
+
+class Game:
+    def __init__(self, preload=True, rate=TICK_RATE, level=1, headless=False,
+            script=None, seed=None, scale=SCALE, filter='nearest', prof=None,
+            pacing='steady', hz=60):
         
-        pygame.joystick.init()
-        self.joys = []
-        idx = 0
-        while True:
-            joy = None
-            try:
-                joy = pygame.joystick.Joystick(idx)
-            except pygame.error:
-                break
-            if not joy:
-                break
-            joy.init()
-            self.joys += [joy]
-            idx+=1
+        self.headless = headless
+        if headless:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        self.script = script
+        
+        # only what the title screen needs is brought up here, the rest is
+        # warmed up on a thread while it shows (see warm)
+        self.boot = []
+        self.warmed = []
+        t = time.time()
+        pygame.display.init()
+        pygame.font.init()
+        self.joys = script.joys if script else []
+        
+        # spawn choice is the only randomness, seed it so runs can be replayed
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        random.seed(seed)
+        self.recorder = None
+        self.done = False
+        self.prof = prof or NullProfiler()
+        self.overlay = False
+        self.effects = False # flash on death, fade in levels
 
         self.TITLE = 0
         self.GAME = 1
         self.WIN = 2
-        self.mode = self.TITLE
+        self.mode = self.GAME if headless else self.TITLE
         
         pygame.display.set_caption(TITLE)
-        self.screen = Screen(pygame.display.set_mode(SCALED_SZ))
+        self.pacer = Pacer(1.0 / rate, pacing, hz)
+        size = (SCREEN_W * scale, SCREEN_H * scale)
+        window = None
+        if pacing != 'steady' and not headless:
+            # only pygame 2 takes vsync, without it frames are slept to hz
+            try:
+                window = pygame.display.set_mode(size, 0, 0, vsync=1)
+                self.pacer.vsync = True
+            except (TypeError, pygame.error):
+                pass
+        self.screen = Screen(window or pygame.display.set_mode(size),
+            scale, filter)
+        t = self.mark(self.boot, 'window', t)
+        self.assets = Assets()
+        self.preload = preload
         self.font = pygame.font.Font(FONT, 8)
-        self.clock = pygame.time.Clock()
+        self.text = Text(self.font)
+        self.booted = self.mark(self.boot, 'font', t)
+        self.hud = (None, None, '')
+        self.dt = 1.0 / rate
+        self.alpha = 0.0
         self.keys = []
-        if len(sys.argv) >= 2:
-            self.level = sys.argv[1]
-        else:
-            self.level = 1
+        self.level = level
         #self.reset_snd = pygame.mixer.Sound('./data/sfx/hurt.wav')
-        self.chan = pygame.mixer.Channel(1)
+        self.chan = None
         
+        self.levels = {}
+        self.streamer = Streamer()
         self.guy = None
         self.world = None
+        self.warmer = None
+        self.warm_error = None
+        self.watcher = None
+        if headless:
+            self.warm()
+            if self.warm_error:
+                raise self.warm_error
+            self.reset()
+        else:
+            self.warmer = threading.Thread(target=self.warm, name='warm-up')
+            self.warmer.daemon = True
+            self.warmer.start()
+            if script:
+                # scripts and replays are input for GAME steps, none of it
+                # is meant for the title
+                self.start()
+
+    def mark(self, log, name, t):
+        now = time.time()
+        log += [(name, now - t)]
+        return now
+    
+    def warm(self):
+        # the mixer, assets and first level, none of which the title needs
+        try:
+            t = time.time()
+            pygame.mixer.init(channels=8)
+            #pygame.mixer.music.load(os.path.join(os.path.expanduser("~"), "mus2.mp3"))
+            self.chan = pygame.mixer.Channel(1)
+            t = self.mark(self.warmed, 'mixer', t)
+            if self.preload:
+                self.assets.preload()
+                t = self.mark(self.warmed, 'assets', t)
+            self.load(self.level)
+            t = self.mark(self.warmed, 'level', t)
+        except Exception as e:
+            self.warm_error = e
+    
+    def start(self):
+        # leaving the title: wait for the warm-up and build the first world
+        if self.mode == self.GAME:
+            return
+        if self.warmer:
+            t = time.time()
+            self.warmer.join()
+            self.warmer = None
+            self.mark(self.warmed, 'waited', t)
+            self.report('warm-up', self.warmed)
+        if self.warm_error:
+            raise self.warm_error
+        self.mode = self.GAME
         self.reset()
+    
+    def probe(self):
+        # joysticks are polled from the title on, so probe after first frame
+        pygame.joystick.init()
+        idx = 0
+        while not self.script:
+            joy = None
+            try:
+                joy = pygame.joystick.Joystick(idx)
+            except pygame.error:
+                break
+            if not joy:
+                break
+            joy.init()
+            self.joys += [joy]
+            idx+=1
+    
+    def report(self, what, log):
+        print '%s %.1fms: %s' % (what, sum(t for name, t in log) * 1000,
+            ', '.join('%s %.1f' % (name, t * 1000) for name, t in log))
 
     def clear(self):
         self.world = None
@@ -508,35 +2146,130 @@ class Game:
         #if self.world:
         #    self.chan.play(self.reset_snd)
         
-        self.world = World('./data/maps/%s.tmx' % self.level, self)
+        self.world = World(self.load(self.level), self)
         if self.guy:
             self.guy.attached = False
             self.flush()
         s = self.world.spawns[random.randint(0,len(self.world.spawns)-1)]
-        self.guy = Guy(game=self, pos=(s.x, s.y))
+        self.guy = Guy(game=self, pos=s)
+        
+        # numbered maps are played in order, start on the next one
+        if isinstance(self.level, int):
+            fn = './data/maps/%s.tmx' % (self.level + 1)
+            if fn not in self.levels:
+                self.streamer.fetch(fn)
+
+    def die(self):
+        if self.effects:
+            self.screen.flash()
+        self.reset()
+    
+    def load(self, level):
+        # parse each map once, resets just build a new World on top of it
+        fn = './data/maps/%s.tmx' % level
+        lev = self.levels.get(fn)
+        if not lev:
+            lev = self.streamer.take(fn) or Level(fn)
+            self.levels[fn] = lev
+        return lev
 
     def __call__(self):
         
+        if self.headless:
+            return self.run()
+        
         self.done = False
+        pacer = self.pacer
+        acc = 0.0
+        first = True
         while True:
-            t = self.clock.tick(60)*0.001
-            self.logic(t)
+            # simulate in fixed steps, however long the frame took
+            acc += pacer.wait()
+            steps = 0
+            while acc >= self.dt and not self.done:
+                if steps == MAX_STEPS:
+                    # too far behind, drop the backlog rather than spiral
+                    acc = 0.0
+                    break
+                t = time.time()
+                self.logic(self.dt)
+                pacer.stepped(time.time() - t)
+                acc -= self.dt
+                steps += 1
             if self.done:
                 break
-            self.render()
-            self.draw()
-        
+            if self.watcher:
+                self.watcher.poll()
+            self.alpha = acc / self.dt
+            if first:
+                # everything between the window and the first frame
+                t = self.mark(self.boot, 'setup', self.booted)
+                self.render()
+                t = self.mark(self.boot, 'title', t)
+                self.draw()
+                self.mark(self.boot, 'present', t)
+                self.report('first frame', self.boot)
+                self.probe()
+                first = False
+            elif pacer.drawing():
+                t = time.time()
+                self.render()
+                pacer.drew(t, self.draw())
+            else:
+                self.prof.count('skipped')
+            # once a loop, drawn or not, so a skipped frame's steps aren't
+            # put down to the next one drawn
+            self.prof.frame()
+
+        pacer.report()
+        return 0
+       
+    def run(self, frames=None):
+        # step as fast as possible without drawing, until the script runs
+        # out, the game is quit or won, or frames steps have run
+        self.done = False
+        n = 0
+        start = time.time()
+        while not self.done and self.mode == self.GAME:
+            if frames is not None and n >= frames:
+                break
+            self.logic(self.dt)
+            self.prof.frame()
+            n += 1
+        elapsed = time.time() - start
+        self.frames = n
+        self.fps = n / elapsed if elapsed else 0.0
         return 0
+    
+    def events(self):
+        evs = pygame.event.get()
+        self.exposed(evs)
+        if self.script:
+            # the script stands in for input, but the window can still be
+            # closed; a replay cut short has no ending to check
+            quit = [ev for ev in evs if ev.type == pygame.QUIT]
+            return quit or self.script.events()
+        return evs
+    
+    def exposed(self, evs):
+        # dirty rects assume the window kept the last frame, which it needn't
+        # once uncovered or restored
+        if any(ev.type in EXPOSE for ev in evs):
+            self.screen.expose()
        
     def flush(self):
         
-        self.world.objects = filter(lambda obj: obj.attached, self.world.objects)
+        self.world.objects.flush()
         
     def logic(self, t):
         
+        prof = self.prof
         if self.mode == self.GAME:
         
-            for ev in pygame.event.get():
+            down = 0
+            with prof('events'):
+                events = self.events()
+            for ev in events:
                 if ev.type == pygame.QUIT:
                     self.done = True
                 elif ev.type == pygame.KEYDOWN:
@@ -547,8 +2280,11 @@ class Game:
                         #self.world = World('./data/maps/%s.tmx' % self.level, self)
                         #self.world.attach(self.guy)
                     self.keys += [ev.key]
+                    down |= KEYBIT.get(ev.key, 0)
                     if ev.key == pygame.K_PAGEUP:
                         self.world.next_level = True
+                    if ev.key == pygame.K_F3 and self.prof.enabled:
+                        self.overlay = not self.overlay
                 elif ev.type == pygame.KEYUP:
                     if ev.key in self.keys:
                         self.keys.remove(ev.key)
@@ -564,50 +2300,62 @@ class Game:
                 #    #if ev.button == 3:
                 #    #    self.guy.running = False
 
-            self.guy.interface()
+            if self.done:
+                return
+            if self.recorder:
+                self.recorder.capture(self, down)
+            with prof('interface'):
+                self.guy.interface()
 
             #self.guy.strafe = pygame.K_LSHIFT in self.keys
             
             try:
-                self.world.logic(t)
+                with prof('world'):
+                    self.world.logic(t)
             except NoSuchLevel:
                 self.mode = self.WIN
                 self.clear()
                 return
                 
             if not self.guy.attached:
-                self.reset()
+                self.die()
             
-            self.flush()
-            for obj in self.world.objects:
-                obj.logic(t)
+            with prof('objects'):
+                self.flush()
+                for obj in self.world.objects:
+                    obj.prev.x = obj.pos.x
+                    obj.prev.y = obj.pos.y
+                    obj.logic(t)
+                    self.world.space.update(obj)
+                self.world.bullets.logic(t)
+            prof.count('entities', len(self.world.objects) + self.world.bullets.count)
 
             #if self.guy.pos.y < 0.0: # allow jumping above
                 #self.reset()
             if self.guy.pos.x < -self.guy.sz.x:
-                self.reset()
+                self.die()
             elif self.guy.pos.x >= self.world.sz.x:
-                self.reset()
+                self.die()
             elif self.guy.pos.y >= self.world.sz.y:
-                self.reset()
+                self.die()
         
         elif self.mode == self.TITLE:
             
-            for ev in pygame.event.get():
+            for ev in self.events():
                 if ev.type == pygame.QUIT:
                     self.done = True
                 elif ev.type == pygame.KEYDOWN:
                     if ev.key == pygame.K_q:
                         self.done = True
                     if ev.key == pygame.K_SPACE or ev.key == pygame.K_RETURN:
-                        self.mode = self.GAME
+                        self.start()
                         #pygame.mixer.music.play()
 
             for joy in self.joys:
                 if joy.get_button(0):
-                        self.mode = self.GAME
+                        self.start()
         elif self.mode == self.WIN:
-            for ev in pygame.event.get():
+            for ev in self.events():
                 if ev.type == pygame.QUIT:
                     self.done = True
                 elif ev.type == pygame.KEYDOWN:
@@ -624,27 +2372,27 @@ class Game:
         self.screen.buf.fill(COLORS[0])
         
         if self.mode == self.GAME:
+            pos = self.guy.lerp(self.alpha)
             view = euclid.Vector2(
-                self.guy.pos.x + self.guy.sz.x/2.0 - SCREEN_W/2.0,
-                self.guy.pos.y + self.guy.sz.x/2.0 - 2.0*SCREEN_H/3.0
+                pos.x + self.guy.sz.x/2.0 - SCREEN_W/2.0,
+                pos.y + self.guy.sz.x/2.0 - 2.0*SCREEN_H/3.0
             )
             view.x = max(0, min(view.x, self.world.sz.x - SCREEN_W))
             view.y = max(0, min(view.y, self.world.sz.y - SCREEN_H))
-            self.world.render(view)
+            with self.prof('render'):
+                self.world.render(view)
             
             
             if self.guy.pos.y >= self.guy.sz.y:
                 pygame.draw.rect(self.screen.buf, COLORS[0], [0, 0, SCREEN_W, 10])
-                tim = str(datetime.timedelta(seconds=self.world.time))
-                tim = str(tim)
-                try:
-                    tim = tim[:tim.index('.')+3]
-                except ValueError:
-                    tim += ".00"
-                    pass
-                tx = "lev " + str(self.level)
-                tx += " " * (20 - len(tim)) + tim
-                self.screen.buf.blit(self.font.render(tx, 1, COLORS[3]), (0,0))
+                # rebuild the line only when the shown time changes
+                cs = int(round(self.world.time * 1000000)) / 10000
+                if self.hud[:2] != (self.level, cs):
+                    tim = timer(self.world.time)
+                    tx = "lev " + str(self.level)
+                    tx += " " * (20 - len(tim)) + tim
+                    self.hud = (self.level, cs, tx)
+                self.text.draw(self.screen.buf, self.hud[2], COLORS[3], (0,0))
         
         elif self.mode == self.TITLE:
             
@@ -661,7 +2409,7 @@ class Game:
                 'Good Luck'
             ]
             for line in text:
-                self.screen.buf.blit(self.font.render(line, 1, COLORS[3]), ((10- len(line)/2)*7,idx))
+                self.screen.buf.blit(self.text.render(line, COLORS[3]), ((10- len(line)/2)*7,idx))
                 idx += 10
         
         elif self.mode == self.WIN:
@@ -678,17 +2426,1288 @@ class Game:
                 'lol'
             ]
             for line in text:
-                self.screen.buf.blit(self.font.render(line, 1, COLORS[3]), ((10- len(line)/2)*7,idx))
+                self.screen.buf.blit(self.text.render(line, COLORS[3]), ((10- len(line)/2)*7,idx))
                 idx += 10
 
         
+        if self.overlay:
+            self.debug()
+        
+    def debug(self):
+        # last frame's scope times and counters, bottom up
+        prof = self.prof
+        lines = ['%-9s %6.2fms' % (name, t * 1000.0)
+            for name, t in sorted(prof.last_times.items())]
+        lines += ['%-9s %7d' % (name, n)
+            for name, n in sorted(prof.last_counts.items())]
+        p50, p99 = self.pacer.percentiles((50, 99))
+        lines += ['frame p50 %5.1fms' % (p50 * 1000.0),
+            'frame p99 %5.1fms' % (p99 * 1000.0)]
+        y = SCREEN_H - 8 * len(lines)
+        pygame.draw.rect(self.screen.buf, COLORS[0], [0, y, SCREEN_W, SCREEN_H - y])
+        for line in lines:
+            self.text.draw(self.screen.buf, line, COLORS[3], (0, y))
+            y += 8
+        
     def draw(self):
         
-        self.screen.render()
-        pygame.display.flip()
+        with self.prof('present'):
+            rects = self.screen.render()
+        if rects:
+            with self.prof('flip'):
+                pygame.display.update(rects)
+        return bool(rects)
+
+def level_name(s):
+    return int(s) if s.isdigit() else s
+
+# multiplayer over UDP: clients JOIN and get a WELCOME with their id, then
+# send INPUT every step (the keys they hold and the last snapshot they
+# decoded), and the server sends a SNAPSHOT every few steps
+JOIN, WELCOME, INPUT, SNAPSHOT, LEAVE = range(5)
+NET_PORT = 7777
+NET_QUANTUM = 8 # snapshot positions are in 1/8ths of a pixel
+NET_HISTORY = 64 # snapshots kept per client to delta against
+NET_TIMEOUT = 5.0 # seconds of silence before a client is dropped
+NET_FIELDS = 3 # x, y and sprite frame of each entity
+NET_BULLET = 1 << 16 # bullet ids start here, players' are below
+NO_BASE = 0xffffffff
+WELCOME_MSG = struct.Struct('<BHHB')
+INPUT_MSG = struct.Struct('<BIIH')
+SNAPSHOT_MSG = struct.Struct('<BII')
+UDP_HEADER = 28 # IPv4 and UDP header bytes on every packet
+
+# keys a client may steer with
+NET_KEYS = [pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN,
+    pygame.K_j, pygame.K_l, pygame.K_i, pygame.K_SPACE]
+NET_MASK = keymask(NET_KEYS)
+
+def unvarint(s, i):
+    n = shift = 0
+    while True:
+        c = ord(s[i])
+        i += 1
+        n |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return n, i
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def delta(state, base):
+    # entities that are new or changed since base, as an id, a bit per field
+    # that changed and the changes as zigzag varints, then the ids gone
+    out = []
+    zero = (0,) * NET_FIELDS
+    for i, fields in state.iteritems():
+        old = base.get(i, zero)
+        if old == fields and i in base:
+            continue
+        bits = 0
+        body = ''
+        for n in xrange(NET_FIELDS):
+            if fields[n] != old[n]:
+                bits |= 1 << n
+                body += varint(zigzag(fields[n] - old[n]))
+        out += [varint(i) + chr(bits) + body]
+    gone = [varint(i) for i in base if i not in state]
+    return varint(len(out)) + ''.join(out) + varint(len(gone)) + ''.join(gone)
+
+def undelta(s, i, base):
+    state = dict(base)
+    n, i = unvarint(s, i)
+    for k in xrange(n):
+        eid, i = unvarint(s, i)
+        bits = ord(s[i])
+        i += 1
+        fields = list(state.get(eid, (0,) * NET_FIELDS))
+        for f in xrange(NET_FIELDS):
+            if bits & (1 << f):
+                d, i = unvarint(s, i)
+                fields[f] += unzigzag(d)
+        state[eid] = tuple(fields)
+    n, i = unvarint(s, i)
+    for k in xrange(n):
+        eid, i = unvarint(s, i)
+        state.pop(eid, None)
+    return state
+
+class Player:
+    # a client of a Server and the guy it steers
+    def __init__(self, pid, addr):
+        self.pid = pid
+        self.addr = addr
+        self.guy = None
+        self.held = []
+        self.seq = -1
+        self.ack = NO_BASE
+        self.seen = time.time()
+        self.sent = collections.OrderedDict() # tick -> state sent
+        self.up = 0 # bytes received and sent, UDP headers included
+        self.down = 0
+
+class Server(Game):
+    # one World with a Guy for each client, steered by the input it sends;
+    # everything is simulated here and clients only get snapshots back,
+    # each a delta against the last one that client said it decoded
+    def __init__(self, level='dm', port=NET_PORT, every=3, seed=None):
+        self.players = {} # address -> Player
+        self.pids = itertools.count(1)
+        self.tick = 0
+        self.every = every
+        self.spent = 0.0 # seconds spent in logic
+        self.steps = 0
+        self.held = {} # key mask -> list of keys
+        Game.__init__(self, level=level, headless=True, seed=seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+    
+    def reset(self):
+        # a fresh world, everyone respawns in it on the next step
+        self.world = World(self.load(self.level), self)
+        for p in self.players.itervalues():
+            p.guy = None
+    
+    def close(self):
+        self.sock.close()
+    
+    def spawn(self, p):
+        s = self.world.spawns[random.randint(0, len(self.world.spawns)-1)]
+        p.guy = Guy(game=self, pos=s)
+    
+    def receive(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except socket.error:
+                break
+            if not data:
+                continue
+            p = self.players.get(addr)
+            kind = ord(data[0])
+            if kind == JOIN:
+                if not p:
+                    p = self.players[addr] = Player(next(self.pids), addr)
+                level = str(self.level)
+                msg = WELCOME_MSG.pack(WELCOME, p.pid, int(round(1.0 / self.dt)),
+                    NET_QUANTUM) + chr(len(level)) + level
+                self.sock.sendto(msg, addr)
+                p.down += len(msg) + UDP_HEADER
+            elif not p:
+                continue
+            elif kind == INPUT and len(data) == INPUT_MSG.size:
+                kind, seq, ack, held = INPUT_MSG.unpack(data)
+                if seq > p.seq:
+                    p.seq = seq
+                    p.ack = ack
+                    held &= NET_MASK
+                    keys = self.held.get(held)
+                    if keys is None:
+                        keys = self.held[held] = [k for k in NET_KEYS if held & KEYBIT[k]]
+                    p.held = keys
+            elif kind == LEAVE:
+                self.leave(p)
+                continue
+            p.up += len(data) + UDP_HEADER
+            p.seen = time.time()
+        
+        now = time.time()
+        for p in self.players.values():
+            if now - p.seen > NET_TIMEOUT:
+                self.leave(p)
+    
+    def leave(self, p):
+        if p.guy:
+            p.guy.attached = False
+        del self.players[p.addr]
+    
+    def logic(self, t):
+        start = time.time()
+        # SDL turns ^C into a QUIT event
+        for ev in self.events():
+            if ev.type == pygame.QUIT:
+                self.done = True
+        self.receive()
+        world = self.world
+        for p in self.players.itervalues():
+            if not p.guy or not p.guy.attached:
+                self.spawn(p)
+            p.guy.ctrl = p.held
+            p.guy.interface()
+        if world.next_level and not isinstance(self.level, int):
+            # named maps lead nowhere, the exit starts this one over
+            self.reset()
+        else:
+            try:
+                world.logic(t)
+            except NoSuchLevel:
+                # past the last numbered map, round again from the first
+                self.level = 1
+                self.reset()
+        # an exit resets everyone onto a new world, they spawn next step
+        world = self.world
+
+        self.flush()
+        for obj in world.objects:
+            obj.prev.x = obj.pos.x
+            obj.prev.y = obj.pos.y
+            obj.logic(t)
+            world.space.update(obj)
+        world.bullets.logic(t)
+        for p in self.players.itervalues():
+            g = p.guy
+            if not g:
+                continue
+            if g.pos.x < -g.sz.x or g.pos.x >= world.sz.x or g.pos.y >= world.sz.y:
+                g.attached = False
+        
+        self.tick += 1
+        if self.tick % self.every == 0:
+            self.send()
+        self.spent += time.time() - start
+        self.steps += 1
+    
+    def state(self):
+        # what clients draw, quantised: id -> (x, y, frame)
+        q = NET_QUANTUM
+        state = {}
+        for p in self.players.itervalues():
+            g = p.guy
+            if g and g.attached:
+                a = int(round(g.anim_point))
+                state[p.pid] = (int(round(g.pos.x * q)), int(round(g.pos.y * q)),
+                    g.frames[g.direction][a])
+        b = self.world.bullets
+        idx = numpy.flatnonzero(b.alive)
+        pos = numpy.rint(b.pos[idx] * q).astype(int).tolist()
+        for i, (x, y) in itertools.izip(idx.tolist(), pos):
+            state[NET_BULLET + i] = (x, y, 0)
+        return state
+    
+    def send(self):
+        state = self.state()
+        bodies = {} # clients acking the same snapshot get the same delta
+        for p in self.players.itervalues():
+            base = p.sent.get(p.ack)
+            if base is None:
+                p.ack = NO_BASE
+            body = bodies.get(p.ack)
+            if body is None:
+                body = bodies[p.ack] = delta(state, base or {})
+            msg = SNAPSHOT_MSG.pack(SNAPSHOT, self.tick, p.ack) + body
+            try:
+                self.sock.sendto(msg, p.addr)
+            except socket.error:
+                pass
+            p.down += len(msg) + UDP_HEADER
+            p.sent[self.tick] = state
+            # the client only ever acks newer snapshots
+            while p.sent and (len(p.sent) > NET_HISTORY or
+                    (p.ack != NO_BASE and next(iter(p.sent)) < p.ack)):
+                p.sent.popitem(last=False)
+
+class Bot:
+    # a client that plays at random, to load a Server with
+    def __init__(self, addr, seed=None, loss=0.0):
+        self.addr = addr
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.rng = random.Random(seed)
+        self.loss = loss # fraction of snapshots to drop, as if lost
+        self.pid = None
+        self.states = collections.OrderedDict() # tick -> decoded state
+        self.ack = NO_BASE
+        self.seq = 0
+        self.held = 0
+        self.hold = 0 # steps until the held keys change
+        self.up = 0
+        self.down = 0
+    
+    def close(self):
+        self.sock.sendto(chr(LEAVE), self.addr)
+        self.sock.close()
+    
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                break
+            self.down += len(data) + UDP_HEADER
+            kind = ord(data[0])
+            if kind == WELCOME:
+                self.pid = WELCOME_MSG.unpack(data[:WELCOME_MSG.size])[1]
+            elif kind == SNAPSHOT and self.rng.random() >= self.loss:
+                kind, tick, base = SNAPSHOT_MSG.unpack(data[:SNAPSHOT_MSG.size])
+                if self.ack != NO_BASE and tick <= self.ack:
+                    continue
+                if base == NO_BASE:
+                    base = {}
+                elif base in self.states:
+                    base = self.states[base]
+                else:
+                    continue
+                self.states[tick] = undelta(data, SNAPSHOT_MSG.size, base)
+                self.ack = tick
+                while len(self.states) > NET_HISTORY:
+                    self.states.popitem(last=False)
+    
+    def update(self):
+        # read snapshots, then send this step's input
+        self.receive()
+        if self.pid is None:
+            msg = chr(JOIN)
+        else:
+            if self.hold <= 0:
+                # run one way or stand, jumping now and then
+                move = self.rng.choice((0, KEYBIT[pygame.K_LEFT], KEYBIT[pygame.K_RIGHT]))
+                jump = KEYBIT[pygame.K_UP] if self.rng.random() < 0.3 else 0
+                self.held = move | jump
+                self.hold = self.rng.randint(10, 60)
+            self.hold -= 1
+            held = self.held
+            if self.rng.random() < 0.05:
+                held |= KEYBIT[pygame.K_SPACE]
+            self.seq += 1
+            msg = INPUT_MSG.pack(INPUT, self.seq, self.ack, held)
+        self.sock.sendto(msg, self.addr)
+        self.up += len(msg) + UDP_HEADER
+    
+    def state(self):
+        return self.states[self.ack] if self.ack in self.states else {}
+
+class Physics(object):
+    # Guy's movement on a flag grid for many guys at once, a step per tick,
+    # by the rules of Guy.interface, Guy.logic, World.sweep and
+    # World.touch; each guy has its own input, the keys it has taken in a
+    # bit mask and, for any of TUNING, either Guy's value or its own
+    TUNING = ['speed', 'jump_vel', 'max_jump_time', 'fall_accel', 'fall_vel']
+    # guys stepped at a time: numpy maps every array bigger than a few
+    # pages afresh, and faulting those in costs more than the arithmetic
+    BLOCK = 4096
+    
+    def __init__(self, flags, tw, th, keys=(), rate=TICK_RATE, **tuning):
+        # keys are (x, y, flags once taken) of each key tile
+        self.t = 1.0 / rate
+        self.tw = float(tw)
+        self.th = float(th)
+        self.shape = flags.shape
+        self.w = flags.shape[1] * tw
+        self.h = flags.shape[0] * th
+        self.keys = [(x, y) for x, y, f in keys]
+        self.full = (1 << len(self.keys)) - 1
+        for name in self.TUNING:
+            setattr(self, name, tuning.pop(name, getattr(Guy, name)))
+        if tuning:
+            raise TypeError('no such tuning: %s' % ', '.join(tuning))
+        
+        # flags of each tile, what they are once the key there is taken,
+        # and the key's bit, flattened with a border of empty tiles that
+        # stand in for everything off the grid
+        w = flags.shape[1] + 2
+        self.flags = numpy.pad(flags, 1, 'constant').ravel().astype(numpy.int32)
+        self.taken = self.flags.copy()
+        self.bits = numpy.zeros(self.flags.shape, numpy.int64)
+        for i, (x, y, f) in enumerate(keys):
+            self.taken[(y + 1) * w + x + 1] = f
+            self.bits[(y + 1) * w + x + 1] = 1 << i
+    
+    @staticmethod
+    def keys_of(level):
+        ys, xs = numpy.nonzero(level.table[level.layers[0]] & KEY)
+        return [(x, y, level.cell(x, y, [(x, y)]))
+            for x, y in zip(xs.tolist(), ys.tolist())]
+    
+    def start(self, x, y):
+        # guys standing still at x, y, with nothing taken
+        x = numpy.array(x, float).ravel()
+        y = numpy.array(y, float).ravel()
+        n = len(x)
+        return (x, y, numpy.zeros(n), numpy.zeros(n, bool), numpy.zeros(n),
+            numpy.zeros(n, bool), numpy.zeros(n, bool), numpy.zeros(n, numpy.int64))
+    
+    def cells(self, i, mask):
+        # flags and key bits of tiles at flat indices i, with the keys in
+        # mask taken
+        f = self.flags.take(i)
+        if not self.keys:
+            return f, 0
+        bits = self.bits.take(i)
+        f = numpy.where(mask & bits, self.taken.take(i), f)
+        return f, numpy.where(f & KEY, bits, 0)
+    
+    def sweep(self, x, y, d, vertical, mask):
+        # World.sweep along one axis for every state; returns the new
+        # position along it, the normal, the flags touched and the new mask.
+        # tiles off the grid are read from its empty border, and each range
+        # of tiles is read up to the longest one, the shorter ones reading
+        # their last tile again, which changes nothing OR'd
+        bx, by = Guy.box.x, Guy.box.y
+        h, w = self.shape
+        if vertical:
+            pos, a, size, asz = y, x, by, bx
+            step, cross, n, m = self.th, self.tw, h, w
+            stride, across = w + 2, 1
+        else:
+            pos, a, size, asz = x, y, bx, by
+            step, cross, n, m = self.tw, self.th, w, h
+            stride, across = 1, w + 2
+        floor, ceil = numpy.floor, numpy.ceil
+        lo = numpy.clip(floor(a / cross), -1, m).astype(numpy.int64)
+        last = numpy.clip(ceil((a + asz) / cross) - 1, -1, m).astype(numpy.int64)
+        # offsets of the tiles across the box, the same on every line
+        offs = [(numpy.minimum(lo + i, last) + 1) * across
+            for i in xrange(int((last - lo).max()) + 1 if len(pos) else 0)]
+        fwd = d > 0
+        c0 = numpy.where(fwd, ceil((pos + size) / step), floor((pos + d) / step))
+        c1 = numpy.where(fwd, ceil((pos + size + d) / step), floor(pos / step))
+        c0 = numpy.clip(c0, 0, n).astype(numpy.int64)
+        c1 = numpy.clip(c1, 0, n).astype(numpy.int64)
+        
+        def line(c):
+            # flags and key bits of line c, OR'd across the box
+            base = (c + 1) * stride
+            f, bits = 0, 0
+            for off in offs:
+                fi, bi = self.cells(base + off, mask)
+                f, bits = f | fi, bits | bi
+            return f, bits
+        
+        # first solid line the leading edge enters, nearest first
+        hit = numpy.full(len(pos), -1, numpy.int64)
+        live = c0 < c1
+        for k in xrange(int((c1 - c0).max()) if live.any() else 0):
+            c = numpy.where(fwd, numpy.minimum(c0 + k, c1 - 1),
+                numpy.maximum(c1 - 1 - k, c0))
+            f, bits = line(c)
+            hit = numpy.where(live & (hit < 0) & ((f & SOLID) != 0), c, hit)
+        got = hit >= 0
+        normal = numpy.where(got, -numpy.sign(d), 0).astype(numpy.int64)
+        new = numpy.where(got, numpy.where(fwd, hit * step - size,
+            (hit + 1) * step), pos + d)
+        
+        # everything between the start and end position, plus the line hit
+        t0 = floor(numpy.minimum(pos, new) / step).astype(numpy.int64)
+        t1 = ceil((numpy.maximum(pos, new) + size) / step).astype(numpy.int64)
+        t1 += normal < 0
+        t0 -= normal > 0
+        t0 = numpy.clip(t0, -1, n)
+        t1 = numpy.clip(t1, t0 + 1, n + 1)
+        touched = numpy.zeros(len(pos), numpy.int32)
+        taken = numpy.zeros(len(pos), numpy.int64)
+        for k in xrange(int((t1 - t0).max()) if len(pos) else 0):
+            f, bits = line(numpy.minimum(t0 + k, t1 - 1))
+            touched |= f
+            taken |= bits
+        return new, normal, touched, mask | taken
+    
+    def step(self, s, mx, j):
+        # one tick for every state in s, moving by mx in [-1, 1] and holding
+        # jump where j; returns the next states and which of them died and
+        # which left by an exit
+        n = len(s[0])
+        if n <= self.BLOCK:
+            return self.tick(s, mx, j, [getattr(self, k) for k in self.TUNING])
+        mx = numpy.broadcast_to(mx, (n,))
+        j = numpy.broadcast_to(j, (n,))
+        tuning = [numpy.broadcast_to(getattr(self, k), (n,)) for k in self.TUNING]
+        out = [self.tick([a[i:i + self.BLOCK] for a in s], mx[i:i + self.BLOCK],
+            j[i:i + self.BLOCK], [v[i:i + self.BLOCK] for v in tuning])
+            for i in xrange(0, n, self.BLOCK)]
+        s = [numpy.concatenate([r[0][k] for r in out]) for k in xrange(len(s))]
+        return (s, numpy.concatenate([r[1] for r in out]),
+            numpy.concatenate([r[2] for r in out]))
+    
+    def tick(self, s, mx, j, tuning):
+        # step for one block of states, with their values of TUNING
+        speed, jump_vel, max_jump_time, fall_accel, fall_vel = tuning
+        x, y, vy, jumping, jt, ground, ladder, mask = s
+        t = self.t
+        start = j & ~jumping & ground
+        jt = numpy.where(start, 0.0, jt)
+        ladder = ladder & ~start
+        jumping = j & (jumping | start)
+        
+        vx = numpy.clip(mx, -1.0, 1.0) * speed
+        vy = numpy.where(ladder, 0.0, vy)
+        up = jumping & (jt < max_jump_time)
+        jt = numpy.where(up, jt + t, jt)
+        fall = numpy.minimum(fall_vel, vy + t * fall_accel/2.0)
+        nvy = numpy.where(up, vy, fall)
+        vy = numpy.where(up, -jump_vel, fall)
+        
+        # an exit lets him through once every key is taken, and wins over
+        # anything else touched in the same step
+        x, normal, fx, mask = self.sweep(x, y, vx * t, False, mask)
+        won = ((fx & EXIT) != 0) & (mask == self.full)
+        y, normal, fy, mask = self.sweep(x, y, vy * t, True, mask)
+        won |= ((fy & EXIT) != 0) & (mask == self.full)
+        f = fx | fy
+        dead = (((f & (KILL | EXIT)) != 0) | (x < -Guy.size[0]) |
+            (x >= self.w) | (y >= self.h)) & ~won
+        nvy = numpy.where(normal != 0, 0.0, nvy)
+        s = [x, y, nvy, jumping, jt, normal < 0, (f & LADDER) != 0, mask]
+        return s, dead, won
+
+class Reach(Physics):
+    # everything a spawn can get to, searched by stepping a frontier of
+    # Physics states under every action
+    ACTIONS = [(mx, j) for j in (False, True) for mx in (0.0, -1.0, 1.0)]
+    
+    def __init__(self, level, rate=TICK_RATE, quantum=1.0):
+        keys = self.keys_of(level)
+        if len(keys) > 16:
+            raise ValueError('%s: too many keys to search' % level.fn)
+        Physics.__init__(self, level.flags, level.tw, level.th, keys, rate)
+        self.q = quantum
+        self.exits = bool(numpy.count_nonzero(level.flags & EXIT))
+        if not quantum:
+            return
+        
+        # a state's key packs its fields into one int64, the radix of each
+        # field being how many values it can take
+        self.margin = 16 * max(level.tw, level.th)
+        self.radix = [
+            int((self.w + 2 * self.margin) / self.q) + 1,
+            int((self.h + 2 * self.margin) / self.q) + 1,
+            int(2 * (Guy.jump_vel + Guy.fall_vel)) + 2,
+            int(round(Guy.max_jump_time * rate)) + 3,
+            2, 2, 1 << len(self.keys)
+        ]
+        if numpy.prod(self.radix, dtype=float) >= 2**62:
+            raise ValueError('%s: map too big to search' % level.fn)
+    
+    def key(self, s):
+        # states with the same key are searched as one: exactly the same
+        # state with no quantum, else the same to within it
+        if not self.q:
+            rows = numpy.column_stack([numpy.asarray(a, float) for a in s])
+            return rows.view('S%d' % (rows.itemsize * len(s))).ravel()
+        x, y, vy, jumping, jt, ground, ladder, mask = s
+        fields = [
+            numpy.round((x + self.margin) / self.q),
+            numpy.round((y + self.margin) / self.q),
+            numpy.round(2 * (vy + Guy.jump_vel)),
+            numpy.where(jumping, numpy.round(jt / self.t) + 1, 0),
+            ground, ladder, mask
+        ]
+        k = numpy.zeros(len(x), numpy.int64)
+        for f, r in zip(fields, self.radix):
+            k = k * r + numpy.clip(f, 0, r - 1).astype(numpy.int64)
+        return k
+    
+    def search(self, spawn, limit):
+        # earliest step each key is taken and the exit reached, whether a
+        # safe place to stand is ever found and how many states were seen;
+        # stops once all of those are known
+        s = self.start(spawn[0], spawn[1])
+        seen = set(self.key(s).tolist())
+        keys = {}
+        exit = None
+        rest = False
+        acts = len(self.ACTIONS)
+        amx = numpy.array([mx for mx, j in self.ACTIONS])
+        aj = numpy.array([j for mx, j in self.ACTIONS])
+        n = 0
+        while n < limit and len(s[0]):
+            if (rest and len(keys) == len(self.keys) and
+                    (exit is not None or not self.exits)):
+                break
+            n += 1
+            # every state under every action, except jumps that can't start
+            # and so do nothing different from not jumping
+            parent = numpy.repeat(numpy.arange(len(s[0])), acts)
+            mx = numpy.tile(amx, len(s[0]))
+            j = numpy.tile(aj, len(s[0]))
+            keep = ~j | s[3][parent] | s[5][parent]
+            parent, mx, j = parent[keep], mx[keep], j[keep]
+            r, dead, won = self.step([a[parent] for a in s], mx, j)
+            
+            if exit is None and won.any():
+                exit = n
+            new = r[7] & ~s[7][parent]
+            for i, k in enumerate(self.keys):
+                if k not in keys and (new & (1 << i)).any():
+                    keys[k] = n
+            alive = ~dead & ~won
+            k = self.key(r)
+            # standing still leaves him where he is for good
+            if not rest:
+                idle = alive & (mx == 0.0) & ~j
+                rest = bool((k[idle] == self.key(s)[parent[idle]]).any())
+            
+            k, first = numpy.unique(k[alive], return_index=True)
+            k = k.tolist()
+            old = numpy.fromiter(itertools.imap(seen.__contains__, k), bool, len(k))
+            seen.update(k)
+            fresh = numpy.flatnonzero(alive)[first[~old]]
+            s = [a[fresh] for a in r]
+        return {'keys': keys, 'exit': exit, 'rest': rest, 'states': len(seen),
+            'steps': n}
+
+def reach(job):
+    fn, spawn, limit, quantum = job
+    t = time.time()
+    level = Level(fn, images=False)
+    search = Reach(level, quantum=quantum)
+    r = search.search(level.spawns[spawn], limit)
+    r.update(fn=fn, spawn=spawn, time=time.time() - t, exits=search.exits,
+        all=search.keys)
+    return r
+
+def analyze(argv):
+    parser = argparse.ArgumentParser(prog='gboy analyze',
+        description='search what Guy can reach from each spawn on the '
+        'keyboard: keys, the exit and a lower bound on the time to finish. with '
+        'a quantum, states that close are merged, which is much faster but '
+        'gives estimates, not bounds, and can miss a route')
+    parser.add_argument('maps', nargs='*',
+        help='tmx files (default: every map in data/maps)')
+    parser.add_argument('--limit', type=float, default=60.0,
+        help='seconds of play to search (default: %(default)s)')
+    parser.add_argument('--quantum', type=float, default=0.5,
+        help='pixels per position bucket, 0 to search every distinct state '
+        'exactly (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='worker processes (default: one per cpu)')
+    args = parser.parse_args(argv)
+    
+    start = time.time()
+    levels = collections.OrderedDict()
+    for fn in args.maps or sorted(glob.glob('./data/maps/*.tmx')):
+        try:
+            levels[fn] = Level(fn, images=False)
+        except NoSuchLevel:
+            print >>sys.stderr, '%s: no such map' % fn
+            return 1
+    # one search per spawn, biggest maps first so the pool stays busy
+    limit = int(args.limit * TICK_RATE)
+    jobs = [(fn, i, limit, args.quantum)
+        for fn, level in levels.items() for i in xrange(len(level.spawns))]
+    jobs.sort(key=lambda job: -levels[job[0]].w * levels[job[0]].h)
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(jobs))))
+    try:
+        results = pool.map(reach, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    
+    bad = 0
+    dt = 1.0 / TICK_RATE
+    best = {}
+    ge = '>='
+    if args.quantum:
+        ge = '~'
+        print ('states within %gpx merged: times are estimates, not bounds, '
+            'and NOT reached may be wrong (--quantum 0 to be exact)' % args.quantum)
+    for fn, level in levels.items():
+        print fn
+        rs = sorted((r for r in results if r['fn'] == fn),
+            key=lambda r: r['spawn'])
+        if not rs:
+            print '  no spawns'
+            bad += 1
+        for r in rs:
+            x, y = level.spawns[r['spawn']]
+            line = '  spawn (%g, %g): ' % (x, y)
+            if r['exit'] is not None:
+                line += 'exit %s %s' % (ge, timer(r['exit'] * dt))
+                best[fn] = min(best.get(fn, r['exit']), r['exit'])
+            elif r['exits']:
+                line += 'exit NOT reached'
+                bad += 1
+            else:
+                line += 'no exit'
+            print line + ', %d states, %.2fs' % (r['states'], r['time'])
+            for k in r['all']:
+                if k in r['keys']:
+                    print '    key (%d, %d) %s %s' % (k + (ge, timer(r['keys'][k] * dt)))
+                else:
+                    print '    key (%d, %d) NOT reached' % k
+                    bad += 1
+            if not r['rest']:
+                print '    nowhere safe to stand, every path dies'
+                bad += 1
+    
+    # the numbered maps are played in order from 1
+    n = 0
+    while './data/maps/%d.tmx' % (n + 1) in best:
+        n += 1
+    if n:
+        total = sum(best['./data/maps/%d.tmx' % i] for i in xrange(1, n + 1))
+        print 'levels 1-%d %s %s' % (n, ge, timer(total * dt))
+    print '%d maps, %d spawns, %d problems in %.1fs' % (
+        len(levels), len(jobs), bad, time.time() - start)
+    return 1 if bad else 0
+
+def compile_levels(argv):
+    parser = argparse.ArgumentParser(prog='gboy compile',
+        description='build the binary .gbl next to each tmx')
+    parser.add_argument('maps', nargs='*',
+        help='tmx files (default: every map in data/maps)')
+    args = parser.parse_args(argv)
+    for fn in args.maps or sorted(glob.glob('./data/maps/*.tmx')):
+        t = time.time()
+        try:
+            level = Level(fn, images=False, binary=False)
+        except NoSuchLevel:
+            print >>sys.stderr, '%s: no such map' % fn
+            return 1
+        out = compiled(fn)
+        level.write(out)
+        print '%s -> %s (%d bytes, %.1f ms)' % (
+            fn, out, os.path.getsize(out), (time.time() - t) * 1000)
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog='gboy serve',
+        description='run a headless multiplayer server')
+    parser.add_argument('level', nargs='?', type=level_name, default='dm')
+    parser.add_argument('--port', type=int, default=NET_PORT)
+    parser.add_argument('--every', type=int, default=3,
+        help='steps between snapshots (default: 3, 20 a second)')
+    parser.add_argument('--bots', type=int, default=0,
+        help='local bot clients to run alongside')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+    server = Server(args.level, args.port, args.every, args.seed)
+    bots = [Bot(('127.0.0.1', server.port), i) for i in xrange(args.bots)]
+    print 'serving %s on udp port %d' % (server.level, server.port)
+    last = time.time()
+    steps, spent = 0, 0.0
+    try:
+        while not server.done:
+            # fixed steps in real time, sleeping off what's left
+            for bot in bots:
+                bot.update()
+            server.logic(server.dt)
+            now = time.time()
+            if now - last >= 5.0:
+                n = server.steps - steps
+                down = sum(p.down for p in server.players.itervalues())
+                print '%d players, %.2fms a step, %.1f kbit/s out' % (
+                    len(server.players), (server.spent - spent) / n * 1000,
+                    down * 8 / 1000.0 / (now - last))
+                for p in server.players.itervalues():
+                    p.up = p.down = 0
+                last, steps, spent = now, server.steps, server.spent
+            time.sleep(max(0.0, server.dt - (time.time() - now)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bot in bots:
+            bot.close()
+        server.close()
+
+def bots(argv):
+    parser = argparse.ArgumentParser(prog='gboy bot',
+        description='connect bot clients to a server')
+    parser.add_argument('server', nargs='?', default='127.0.0.1:%d' % NET_PORT,
+        help='host:port (default: 127.0.0.1:%d)' % NET_PORT)
+    parser.add_argument('-n', type=int, default=1, help='bots to run')
+    parser.add_argument('--rate', type=int, default=TICK_RATE)
+    args = parser.parse_args(argv)
+    host, port = args.server.rsplit(':', 1)
+    clients = [Bot((host, int(port)), i) for i in xrange(args.n)]
+    try:
+        while True:
+            for bot in clients:
+                bot.update()
+            time.sleep(1.0 / args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bot in clients:
+            bot.close()
+
+def netbench(argv):
+    # server and bots in one process, in lockstep: every step the bots read
+    # what was sent and answer, then the server steps, so the numbers are
+    # the server's own cost and traffic, not the scheduler's
+    parser = argparse.ArgumentParser(prog='gboy netbench',
+        description='server step cost and bandwidth as players are added')
+    parser.add_argument('level', nargs='?', type=level_name, default='dm')
+    parser.add_argument('--players', default='1,2,4,8,16,32',
+        help='comma separated player counts')
+    parser.add_argument('--steps', type=int, default=600)
+    parser.add_argument('--every', type=int, default=3)
+    parser.add_argument('--loss', type=float, default=0.0,
+        help='fraction of snapshots each bot drops')
+    args = parser.parse_args(argv)
+    print '%7s %9s %12s %9s %9s %11s %11s' % ('players', 'step ms',
+        'us/player', 'snap B', 'full B', 'down kbps', 'up kbps')
+    for n in [int(s) for s in args.players.split(',')]:
+        server = Server(args.level, 0, args.every, seed=n)
+        clients = [Bot(('127.0.0.1', server.port), i, args.loss) for i in xrange(n)]
+        for i in xrange(2 * TICK_RATE):
+            for bot in clients:
+                bot.update()
+            server.logic(server.dt)
+        for p in server.players.itervalues():
+            p.up = p.down = 0
+        spent, steps = server.spent, server.steps
+        for i in xrange(args.steps):
+            for bot in clients:
+                bot.update()
+            server.logic(server.dt)
+        step = (server.spent - spent) / (server.steps - steps)
+        secs = args.steps * server.dt
+        players = server.players.values()
+        snaps = args.steps / args.every
+        down = sum(p.down for p in players) / float(n)
+        up = sum(p.up for p in players) / float(n)
+        print '%7d %9.3f %12.1f %9.1f %9d %11.2f %11.2f' % (n, step * 1000,
+            step / n * 1e6, down / snaps - UDP_HEADER - SNAPSHOT_MSG.size,
+            len(delta(server.state(), {})), down * 8 / 1000.0 / secs,
+            up * 8 / 1000.0 / secs)
+        for bot in clients:
+            bot.close()
+        server.close()
+
+def enlarge(level, kx, ky, out):
+    # level repeated kx by ky times, compiled to out; its tileset paths are
+    # made absolute so it loads from anywhere
+    big = copy.copy(level)
+    big.layers = [numpy.tile(layer, (ky, kx)) for layer in level.layers]
+    big.flags = numpy.tile(level.flags, (ky, kx))
+    big.w = level.w * kx
+    big.h = level.h * ky
+    big.keys = level.keys * kx * ky
+    base = os.path.dirname(os.path.abspath(level.fn))
+    big.tilesets = [ts[:-1] + (os.path.normpath(os.path.join(base, ts[-1])),)
+        for ts in level.tilesets]
+    big.write(out)
+
+def measure(f, n, repeat=7):
+    # median seconds per call of f(i) over repeat batches of n calls
+    times = []
+    i = 0
+    for r in xrange(repeat):
+        t = time.time()
+        for k in xrange(n):
+            f(i)
+            i += 1
+        times += [(time.time() - t) / n]
+    return sorted(times)[len(times) / 2]
+
+def bench_map(game, name, fn, rng, n, tmp):
+    # microseconds per operation on one map
+    r = {}
+    # loading the tmx and the compiled map are timed apart, whichever a
+    # .gbl next to the tmx would have Level pick; the enlarged maps only
+    # exist compiled
+    r['tmx'] = None
+    if os.path.exists(fn):
+        r['tmx'] = measure(lambda i: Level(fn, binary=False), max(1, n / 50))
+        src = os.path.join(tmp, '%s-gbl.tmx' % name)
+        enlarge(Level(fn, images=False, binary=False), 1, 1, compiled(src))
+    else:
+        src = fn
+    r['gbl'] = measure(lambda i: Level(src), max(1, n / 50))
+    game.level = name
+    game.levels['./data/maps/%s.tmx' % name] = level = Level(fn)
+    r['world'] = measure(lambda i: World(level, game), n / 10)
+    r['reset'] = measure(lambda i: game.reset(), n / 10)
+    world = game.world
+    w, h = world.sz
+    
+    # collision against rects from a tile to two tiles across
+    probes = []
+    for i in xrange(n):
+        sz = (rng.uniform(level.tw, 2 * level.tw), rng.uniform(level.th, 2 * level.th))
+        probes += [Object(pos=(rng.uniform(0, w - sz[0]), rng.uniform(0, h - sz[1])), sz=sz)]
+    r['collision'] = measure(lambda i: world.collision(probes[i % n]), n)
+    
+    # a guy running and jumping at random, respawned when it dies
+    keys = [[], [pygame.K_LEFT], [pygame.K_RIGHT], [pygame.K_RIGHT, pygame.K_UP],
+        [pygame.K_LEFT, pygame.K_UP], [pygame.K_UP]]
+    inputs = [keys[rng.randrange(len(keys))] for i in xrange(n / 20)]
+    def step(i):
+        guy = game.guy
+        if not guy.attached or not 0 <= guy.pos.y < h:
+            game.reset()
+            guy = game.guy
+        guy.ctrl = inputs[(i / 20) % len(inputs)]
+        guy.interface()
+        guy.logic(game.dt)
+    r['guy'] = measure(step, n)
+    game.reset()
+    
+    # chunks baked anywhere, then drawing a few views whose chunks stay
+    # cached, then the whole of buf scaled to the window
+    chunks = [(rng.randrange((level.w + CHUNK - 1) / CHUNK),
+        rng.randrange((level.h + CHUNK - 1) / CHUNK)) for i in xrange(n / 10)]
+    r['bake'] = measure(lambda i: level.bake(*chunks[i % len(chunks)]), n / 10)
+    views = [euclid.Vector2(rng.uniform(0, max(0, w - SCREEN_W)),
+        rng.uniform(0, max(0, h - SCREEN_H))) for i in xrange(16)]
+    for view in views:
+        world.render(view)
+    r['render'] = measure(lambda i: world.render(views[i % len(views)]), n / 10)
+    screen = game.screen
+    def present(i):
+        screen.last = None
+        screen.render()
+    r['present'] = measure(present, n / 20)
+    
+    # bullet storms: a burst fired from all over, then stepped until gone
+    guy = game.guy
+    bullets = world.bullets
+    spots = [(rng.uniform(0, w), rng.uniform(0, h)) for i in xrange(n)]
+    def shoot(i):
+        guy.pos.x, guy.pos.y = spots[i % n]
+        guy.direction = 'left' if i & 1 else 'right'
+        guy.shoot_time = 0
+        guy.shoot()
+    r['shoot'] = measure(shoot, n)
+    times = []
+    for k in xrange(7):
+        for i in xrange(256):
+            shoot(i)
+        live = 0
+        t = time.time()
+        for i in xrange(10):
+            live += bullets.count
+            bullets.logic(game.dt)
+        times += [(time.time() - t) / max(1, live)]
+    r['bullets'] = sorted(times)[len(times) / 2]
+    return dict((k, v if v is None else v * 1e6) for k, v in r.items())
+
+BENCH_METRICS = ['tmx', 'gbl', 'world', 'reset', 'collision', 'guy', 'bake',
+    'render', 'present', 'shoot', 'bullets']
+
+def bench(argv):
+    parser = argparse.ArgumentParser(prog='gboy bench',
+        description='time the hot paths on every map; microseconds per '
+            'operation, bullets per live bullet')
+    parser.add_argument('maps', nargs='*',
+        help='tmx files (default: every map in data/maps)')
+    parser.add_argument('-n', type=int, default=500,
+        help='operations per batch (default: 500)')
+    parser.add_argument('--enlarge', default='3',
+        help='map to also repeat 2x2, 4x4 and 8x8 times, "" for none')
+    parser.add_argument('--out', help='write results to this json file')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help='slowdown over the baseline that fails (default: 0.25)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    maps = args.maps or sorted(glob.glob('./data/maps/*.tmx'))
+    game = Game(headless=True, level=level_name(
+        os.path.splitext(os.path.basename(maps[0]))[0]), seed=args.seed)
+    # a desktop window is 32 bit, the dummy driver's defaults to 8
+    game.screen = Screen(pygame.display.set_mode(
+        (SCREEN_W * SCALE, SCREEN_H * SCALE), 0, 32))
+    
+    jobs = [(level_name(os.path.splitext(os.path.basename(fn))[0]), fn)
+        for fn in maps]
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix='gboy-bench-')
+    if args.enlarge:
+        src = Level('./data/maps/%s.tmx' % args.enlarge, images=False)
+        for k in (2, 4, 8):
+            name = '%sx%d' % (args.enlarge, k * k)
+            fn = os.path.join(tmp, name + '.tmx')
+            enlarge(src, k, k, compiled(fn))
+            jobs += [(name, fn)]
+    
+    results = {}
+    base = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)['results']
+    print '%-6s %7s' % ('map', 'tiles') + ''.join('%10s' % m for m in BENCH_METRICS)
+    slow = []
+    try:
+        for name, fn in jobs:
+            r = bench_map(game, name, fn, random.Random(args.seed), args.n, tmp)
+            level = game.world.level
+            r['tiles'] = level.w * level.h
+            results[str(name)] = r
+            print '%-6s %7d' % (name, r['tiles']) + ''.join(
+                '%10s' % '-' if r[m] is None else '%10.1f' % r[m]
+                for m in BENCH_METRICS)
+            old = base.get(str(name))
+            if not old:
+                continue
+            line = ''
+            for m in BENCH_METRICS:
+                if not old.get(m) or r[m] is None:
+                    line += '%10s' % '-'
+                    continue
+                change = r[m] / old[m] - 1.0
+                line += '%+9.0f%%' % (change * 100)
+                if change > args.threshold:
+                    slow += ['%s %s %+.0f%%' % (name, m, change * 100)]
+            print '%14s' % '' + line
+    finally:
+        import shutil
+        shutil.rmtree(tmp)
+    
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'results': results, 'n': args.n, 'seed': args.seed,
+                'python': sys.version.split()[0], 'pygame': pygame.version.ver,
+                'numpy': numpy.__version__}, f, indent=1, sort_keys=True)
+    if slow:
+        print '%d slower than the baseline by over %d%%: %s' % (
+            len(slow), args.threshold * 100, ', '.join(slow))
+        return 1
+    return 0
+
+def span(s):
+    # "a", "a,b,c" or "a:b:step", the last with b included
+    if ':' in s:
+        a, b, step = map(float, s.split(':'))
+        if step <= 0 or b < a:
+            raise ValueError(s)
+        return list(numpy.arange(a, b + step / 2.0, step))
+    return [float(v) for v in s.split(',')]
+
+def jumps(tuning, seconds, rate=TICK_RATE, gaps=None, arcs=False):
+    # every combination of tuning (lists of values of Physics.TUNING) on
+    # lanes of flat floor, one with a gap of each width up to gaps: a
+    # standing jump held from the start, and running jumps held from the
+    # last step on the edge of the floor; returns per combination arrays,
+    # the arcs of the running jump on flat floor if arcs
+    names = Physics.TUNING
+    combos = list(itertools.product(*[tuning[k] for k in names]))
+    c = len(combos)
+    tune = dict((k, numpy.array([p[i] for p in combos], float))
+        for i, k in enumerate(names))
+    t = 1.0 / rate
+    tile = 8
+    
+    # lanes are sized by what the tuning can at most do: rise at jump_vel,
+    # then half of fall_accel takes it away, and it falls no faster than
+    # fall_vel
+    speed, jv, fa, fv = (tune['speed'], tune['jump_vel'], tune['fall_accel'],
+        tune['fall_vel'])
+    rise = jv * (tune['max_jump_time'] + t) + jv ** 2 / fa
+    air = tune['max_jump_time'] + 2 * (jv + fv) / fa + rise / fv + 2 * t
+    far = float((speed * air).max())
+    if gaps is None:
+        gaps = int(math.ceil(far / tile)) + 1
+    edge = 3 # tiles of floor before the gap
+    room = int(math.ceil(float(rise.max()) / tile)) + 2
+    lane = room + 3 # ceiling, room, floor and a pit under the gap
+    flags = numpy.zeros(((gaps + 1) * lane + 1,
+        edge + gaps + int(math.ceil(far / tile)) + 4), numpy.uint8)
+    for g in xrange(gaps + 1):
+        flags[g * lane] = SOLID
+        flags[g * lane + room + 1, :edge] = SOLID
+        flags[g * lane + room + 1, edge + g:] = SOLID
+    flags[-1] = SOLID
+    
+    # standing guys on the first lane, then a running guy per lane
+    n = c * (gaps + 2)
+    which = numpy.concatenate([[0], numpy.arange(gaps + 1)]).repeat(c)
+    run = numpy.arange(n) >= c
+    x = numpy.where(run, (edge - 1) * tile, tile).astype(float)
+    y = ((which * lane + room + 1) * tile - Guy.box.y).astype(float)
+    physics = Physics(flags, tile, tile, rate=rate, **dict(
+        (k, numpy.tile(v, gaps + 2)) for k, v in tune.items()))
+    speed = numpy.tile(speed, gaps + 2)
+    s = physics.start(x, y)
+    mx = run.astype(float)
+    
+    took = numpy.full(n, -1)
+    land = numpy.full(n, -1)
+    tx, ty, lx, ly = x.copy(), y.copy(), x.copy(), y.copy()
+    apex = y.copy()
+    alive = numpy.ones(n, bool)
+    arc = []
+    for i in xrange(int(seconds * rate)):
+        x, y = s[0], s[1]
+        j = ((took >= 0) | (run & (x + speed * t >= edge * tile)) |
+            (~run & (i > 0)))
+        s, dead, won = physics.step(s, mx, j)
+        start = s[3] & (took < 0) & alive
+        took[start] = i
+        tx[start], ty[start] = x[start], y[start]
+        flying = alive & (took >= 0) & (land < 0)
+        apex = numpy.where(flying, numpy.minimum(apex, s[1]), apex)
+        down = flying & s[5]
+        land[down] = i
+        lx[down], ly[down] = s[0][down], s[1][down]
+        alive &= ~dead
+        if arcs:
+            arc.append(numpy.where(flying, s[1], numpy.nan)[c:2 * c] - ty[c:2 * c])
+            arc.append(s[0][c:2 * c] - tx[c:2 * c])
+        if not (alive & (land < 0)).any():
+            break
+    
+    # back on the floor it left from, past the gap
+    ok = (land >= 0) & (ly == ty)
+    cleared = ok[2 * c:].reshape(gaps, c)
+    widest = (cleared * numpy.arange(1, gaps + 1)[:, None]).max(axis=0)
+    at = numpy.arange(c) + (widest + 1) * c
+    r = {
+        'combos': combos,
+        'apex': numpy.where(land[:c] >= 0, ty[:c] - apex[:c], numpy.nan),
+        'air': numpy.where(land[:c] >= 0, (land[:c] - took[:c]) * t, numpy.nan),
+        'reach': numpy.where(ok[c:2 * c], lx[c:2 * c] - tx[c:2 * c], numpy.nan),
+        'gap': widest,
+        'land': numpy.where(widest > 0, lx[at] - (edge + widest) * tile, numpy.nan),
+        'guys': n,
+        'steps': i + 1,
+    }
+    if arcs:
+        ys = numpy.array(arc[0::2])
+        xs = numpy.array(arc[1::2])
+        r['arcs'] = [[(float(a), float(b)) for a, b in zip(xs[:, k], ys[:, k])
+            if b == b] for k in xrange(c)]
+    return r
+
+def plot(arc, dx=2.0, dy=4.0):
+    # side view of an arc of (x, y) offsets, y up being negative
+    if not arc:
+        return []
+    w = int(max(x for x, y in arc) / dx) + 1
+    h = int(-min(y for x, y in arc) / dy) + 1
+    rows = [[' '] * w for i in xrange(h)]
+    for x, y in arc:
+        if x >= 0 and -y >= 0:
+            rows[h - 1 - int(-y / dy)][int(x / dx)] = 'o'
+    return [''.join(row).rstrip() for row in rows] + ['=' * w]
+
+def sweep(argv):
+    parser = argparse.ArgumentParser(prog='gboy sweep',
+        description='jump every combination of Guy\'s tuning on flat floor '
+            'and over gaps; values are "a", "a,b,c" or "a:b:step"')
+    for k in Physics.TUNING:
+        parser.add_argument('--' + k.replace('_', '-'), type=span,
+            default=[getattr(Guy, k)], metavar='VALUES',
+            help='(default: %s)' % getattr(Guy, k))
+    parser.add_argument('--time', type=float, default=3.0,
+        help='seconds of play to simulate (default: %(default)s)')
+    parser.add_argument('--gaps', type=int,
+        help='widest gap in tiles to try (default: as far as it can jump)')
+    parser.add_argument('--rows', type=int, default=20,
+        help='combinations to print, evenly spread (default: %(default)s)')
+    parser.add_argument('--arc', action='store_true',
+        help='draw the running jump of each printed combination')
+    parser.add_argument('--out', help='write every combination to this json file')
+    args = parser.parse_args(argv)
+    
+    start = time.time()
+    tuning = dict((k, getattr(args, k)) for k in Physics.TUNING)
+    r = jumps(tuning, args.time, gaps=args.gaps, arcs=args.arc or bool(args.out))
+    elapsed = time.time() - start
+    
+    # apex and air of a standing jump, reach of a running one, the widest
+    # gap a running jump clears and how far past it that lands
+    combos = r['combos']
+    cols = ['apex', 'air', 'reach', 'gap', 'land']
+    print ''.join('%14s' % k for k in Physics.TUNING) + ''.join('%7s' % k for k in cols)
+    shown = sorted(set(numpy.linspace(0, len(combos) - 1,
+        min(args.rows, len(combos))).round().astype(int).tolist()))
+    for i in shown:
+        line = ''.join('%14g' % v for v in combos[i])
+        line += '%7.1f%7.2f%7.1f%7d%7.1f' % tuple(r[k][i] for k in cols)
+        print line.replace('nan', '  -')
+        if args.arc:
+            for row in plot(r['arcs'][i]):
+                print ' ' * 4 + row
+    if len(shown) < len(combos):
+        print '(%d of %d combinations shown)' % (len(shown), len(combos))
+    print '%d combinations, %d guys for %d steps in %.1fs' % (
+        len(combos), r['guys'], r['steps'], elapsed)
+    
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'rate': TICK_RATE, 'tuning': Physics.TUNING,
+                'results': [dict(zip(Physics.TUNING, combos[i]) + [(k,
+                    None if r[k][i] != r[k][i] else float(r[k][i]))
+                    for k in cols] + [('arc', r['arcs'][i])])
+                    for i in xrange(len(combos))]}, f, indent=1)
+    return 0
+
+COMMANDS = {
+    'compile': compile_levels,
+    'analyze': analyze,
+    'serve': serve,
+    'bot': bots,
+    'netbench': netbench,
+    'bench': bench,
+    'sweep': sweep,
+}
 
 def main():
-    return Game()()
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+    parser = argparse.ArgumentParser(prog='gboy')
+    parser.add_argument('level', nargs='?', type=level_name, default=1)
+    parser.add_argument('--headless', action='store_true',
+        help='no window or sound, run the simulation as fast as possible')
+    parser.add_argument('--frames', type=int,
+        help='stop a headless run after this many steps')
+    parser.add_argument('--script',
+        help='scripted input, lines of "<steps> [key ...]"')
+    parser.add_argument('--scale', type=int, default=SCALE,
+        help='window size as a multiple of %dx%d' % SCREEN_SZ)
+    parser.add_argument('--filter', choices=('nearest', 'scale2x'),
+        default='nearest', help='upscaling filter')
+    parser.add_argument('--seed', type=int, help='seed for spawn choice')
+    parser.add_argument('--profile',
+        help='write a chrome://tracing timeline of each frame to this file')
+    parser.add_argument('--overlay', action='store_true',
+        help='show frame timings and counters (toggle with F3)')
+    parser.add_argument('--record', help='write input to a replay file')
+    parser.add_argument('--replay', help='play back a replay file')
+    parser.add_argument('--effects', action='store_true',
+        help='flash on death and fade into each level')
+    parser.add_argument('--watch', action='store_true',
+        help='patch in maps and graphics as they are saved')
+    parser.add_argument('--pacing', choices=Pacer.MODES, default='steady',
+        help='sleep to --hz, wait on vsync, or vsync starting frames as late '
+        'as they can so input is freshest')
+    parser.add_argument('--hz', type=int, default=60,
+        help='display refresh rate frames are paced to')
+    args = parser.parse_args()
+    
+    script = Script.load(args.script) if args.script else None
+    level, rate, seed = args.level, TICK_RATE, args.seed
+    if args.replay:
+        script = Replay(args.replay)
+        level, rate, seed = script.level, script.rate, script.seed
+    prof = None
+    if args.profile or args.overlay:
+        prof = Profiler(trace=bool(args.profile))
+    game = Game(level=level, rate=rate, headless=args.headless,
+        script=script, seed=seed, scale=args.scale, filter=args.filter,
+        prof=prof, pacing=args.pacing, hz=args.hz)
+    game.overlay = args.overlay
+    game.effects = args.effects
+    if args.record:
+        game.recorder = Recorder(args.record, game)
+    if args.watch:
+        game.watcher = Watcher(game)
+    try:
+        if not args.headless:
+            r = game()
+        else:
+            r = game.run(args.frames)
+            print '%d frames, %.0f fps (%.1fx real time)' % (
+                game.frames, game.fps, game.fps * game.dt)
+    finally:
+        if game.recorder:
+            game.recorder.close()
+        if args.profile:
+            prof.save(args.profile)
+    if args.replay:
+        diverged = script.check(game)
+        if diverged:
+            print >>sys.stderr, 'replay diverged: %s' % diverged
+            return 1
+    return r
 
 if __name__=='__main__':
     sys.exit(main())